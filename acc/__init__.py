@@ -1,11 +1,25 @@
 import acc.importers
 
+import bisect
+import concurrent.futures
+import contextlib
 import copy
+import csv
 import datetime
+import functools
+import hashlib
 import importlib
+import itertools
 import json
+import mmap
+import os
 import pkgutil
+import re
 import shlex
+import stat
+import sys
+import threading
+import time
 import uuid
 
 ## Exceptions
@@ -39,15 +53,21 @@ class UserDataError(Failure):
 
 ## Usage
 
-TOPLEVEL_USAGE = "[-C <dir>] [--git | --no-git] [--] <subcommand> [<arg>...]"
+TOPLEVEL_USAGE = "[-C <dir>] [--git | --no-git] [--metrics <file>] [--] <subcommand> [<arg>...]"
 
 SUBCOMMAND_USAGE = {
     "init": "<dir>",
     "import": "<importer> [<arg>...]",
     "merge": "[--require-overlap | --no-require-overlap] [--] <source-ledger> <target-ledger>",
+    "check-refs": "[--ref <key> <ledger>]... [--] [<ledger>...]",
+    "check": "[--jobs <n>] [--] [<ledger>...]",
+    "diff": "[--] <old-ledger> <new-ledger>",
+    "rollup": "[--jobs <n>] [--] [<ledger>...]",
+    "export": "[--] <export-dir> [<ledger>...]",
 }
 
-SUBCOMMANDS = ("init", "import", "merge")
+SUBCOMMANDS = ("init", "import", "merge", "check-refs", "check", "diff",
+               "rollup", "export")
 
 SUBCOMMANDS_USING_GIT = ("import", "merge")
 SUBCOMMANDS_REQUESTING_GIT = ("init")
@@ -78,12 +98,183 @@ def usage(subcommand=None, config=None, config_error=None):
 def usage_error(*args, **kwargs):
     return StandardUsageError(usage(*args, **kwargs))
 
+## Metrics
+
+# Counters that are always present in a metrics record, even if the
+# subcommand did not touch them.
+METRICS_COUNTERS = (
+    "bytes-read",
+    "bytes-written",
+    "bytes-mapped",
+    "rows-parsed",
+    "transactions-merged",
+    "subprocesses",
+)
+
+def peak_rss():
+    # Return the peak resident set size of this process and of its
+    # largest waited-for child, in bytes, or None where unavailable.
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+class Metrics:
+    # Measurements taken while running one command. Counters may be
+    # updated from the pre-flight thread, hence the lock.
+
+    def __init__(self):
+        self.fields = {}
+        self.counters = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def set(self, name, value):
+        self.fields[name] = value
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Phases with the same name add up.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def record(self, status):
+        record = dict(self.fields)
+        record["status"] = status
+        record["duration"] = time.perf_counter() - self.start
+        for name in METRICS_COUNTERS:
+            record[name] = self.counters.get(name, 0)
+        for name in self.counters:
+            record.setdefault(name, self.counters[name])
+        parse_time = self.phases.get("parse")
+        if parse_time:
+            record["rows-per-second"] = record["rows-parsed"] / parse_time
+        else:
+            record["rows-per-second"] = None
+        record["peak-rss"], record["peak-rss-children"] = peak_rss()
+        record["phases"] = dict(self.phases)
+        return record
+
+def io_metrics(io):
+    # The metrics of the current command, or a throwaway instance for
+    # IO objects that do not collect any.
+    return getattr(io, "metrics", None) or Metrics()
+
+class MeteredFile:
+    # File object wrapper that adds the number of bytes between where
+    # the file was opened and where it was closed to the metrics, so
+    # that reads and writes themselves have no overhead.
+
+    def __init__(self, file, mode, metrics):
+        self.file = file
+        self.metrics = metrics
+        self.counter = "bytes-written" if any(
+            char in mode for char in "wax+") else "bytes-read"
+        self.start = self.tell_or_none()
+
+    def tell_or_none(self):
+        try:
+            return self.file.tell()
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def close(self):
+        if self.start is not None and not self.file.closed:
+            end = self.tell_or_none()
+            if end is not None:
+                self.metrics.count(self.counter, end - self.start)
+            self.start = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
 ## IOWrapper
 
 class IOWrapper:
     def __init__(self, io, exec_name):
         self.io = io
         self.exec_name = exec_name
+        self.config = None
+        self.preflight = None
+        self.metrics = Metrics()
+        self.metrics_file = None
+        self.writes = WriteBatch(self)
+
+    def start_preflight(self, function, *args):
+        # Run checks that must pass before anything is written in a
+        # worker thread, so that they overlap with reading input.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.preflight = executor.submit(function, *args)
+        executor.shutdown(wait=False)
+
+    def wait_for_preflight(self):
+        # Re-raises the exception of a failed check every time.
+        if self.preflight is not None:
+            with self.metrics.phase("preflight-wait"):
+                self.preflight.result()
+
+    def open(self, path, mode="r", *args, **kwargs):
+        if any(char in mode for char in "wax+"):
+            self.wait_for_preflight()
+        return MeteredFile(
+            self.io.open(path, mode, *args, **kwargs), mode, self.metrics)
+
+    def run(self, *args, **kwargs):
+        self.metrics.count("subprocesses")
+        return self.io.run(*args, **kwargs)
+
+    def emit_metrics(self, status):
+        # Append the metrics record as a line of JSON to the file given
+        # with --metrics, or print it to stderr if that was "-". The
+        # file is not a ledger, so it bypasses the pre-flight checks.
+        if self.metrics_file is None:
+            return
+        line = json.dumps(self.metrics.record(status), sort_keys=True)
+        if self.metrics_file == "-":
+            self.print_stderr(line)
+            return
+        try:
+            with self.io.open(self.metrics_file, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            self.print_error("could not write metrics to {}: {}".format(
+                repr(self.metrics_file), str(e)))
+
+    def makedirs(self, *args, **kwargs):
+        self.wait_for_preflight()
+        return self.io.makedirs(*args, **kwargs)
+
+    def replace(self, *args, **kwargs):
+        self.wait_for_preflight()
+        return self.io.replace(*args, **kwargs)
+
+    def mkstemp(self, *args, **kwargs):
+        self.wait_for_preflight()
+        return self.io.mkstemp(*args, **kwargs)
 
     def print(self, *args, stream=None, **kwargs):
         if stream is None:
@@ -119,6 +310,31 @@ def quote_command(args):
 def random_transaction_id():
     return str(uuid.uuid4())
 
+ID_SCHEMES = ("random", "content")
+
+# Arbitrary, but must never change, or content-derived IDs will no
+# longer match those of transactions imported earlier.
+TRANSACTION_ID_NAMESPACE = uuid.UUID("5d0c3b54-8a4e-4f0e-9a63-4f1b2c7de9a1")
+
+def content_transaction_id(importer, account, identity):
+    # Derive a stable ID from the importer name, the account, and
+    # whatever identifies the row in the importer's input (its native
+    # transaction ID if there is one, otherwise its contents), so that
+    # importing the same row again yields the same ID.
+    name = json.dumps([importer, account, identity])
+    return str(uuid.uuid5(TRANSACTION_ID_NAMESPACE, name))
+
+def transaction_id(id_scheme, importer, account, identity):
+    if id_scheme == "content":
+        return content_transaction_id(importer, account, identity)
+    return random_transaction_id()
+
+def id_scheme(io):
+    # The ID scheme selected by the configuration of the current
+    # command.
+    config = getattr(io, "config", None) or {}
+    return config.get("id-scheme", "random")
+
 DATE_FORMAT = "%Y-%m-%d"
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S%z"
 
@@ -163,6 +379,29 @@ def ensure_working_tree_clean(io):
                 .format(str(e)))
         raise FilesystemError("working directory is not clean")
 
+def check_work_tree(io):
+    result = io.run(["git", "rev-parse", "--is-inside-work-tree"],
+                    stdout=io.PIPE)
+    if result.returncode != 0:
+        raise ExternalCommandError(
+            "command failed: {}".format(quote_command(result.args)))
+    response = result.stdout.decode().strip()
+    if response != "true":
+        raise ExternalCommandError(
+            "unexpected response from command '{}': {}"
+            .format(quote_command(result.args), response))
+
+def git_preflight(io, should_check_work_tree):
+    with io_metrics(io).phase("git-preflight"):
+        try:
+            if should_check_work_tree:
+                check_work_tree(io)
+        except OSError as e:
+            raise ExternalCommandError(
+                "unexpected failure while running 'git': {}"
+                .format(str(e)))
+        ensure_working_tree_clean(io)
+
 def commit_working_tree(io, message):
     if not io.which("git"):
         return
@@ -179,48 +418,1069 @@ def commit_working_tree(io, message):
             .format(str(e)))
 
 ## Serialization
+### Transactions
+
+def serialize_transaction(transaction):
+    transaction = dict(transaction)
+    if "date" in transaction:
+        date = transaction["date"]
+        if date is None:
+            date_str = None
+        elif isinstance(date, datetime.date):
+            date_str = date.strftime(DATE_FORMAT)
+        elif isinstance(date, datetime.datetime):
+            date_str = date.strftime(DATETIME_FORMAT)
+        else:
+            raise InternalError(
+                "cannot serialize date of type {}: {}"
+                .format(repr(type(date)), repr(date)))
+        transaction["date"] = date_str
+    return transaction
+
+def deserialize_transaction(transaction):
+    if "date" in transaction:
+        date = transaction["date"]
+        try:
+            if is_datetime(date):
+                date = datetime.datetime.strptime(date, DATETIME_FORMAT)
+            else:
+                date = datetime.datetime.strptime(date, DATE_FORMAT).date()
+        except ValueError:
+            raise UserDataError("malformed date: {}".format(date))
+        transaction["date"] = date
+    return transaction
 
-def serialize_ledger(ledger):
-    transactions = []
-    for transaction in ledger["transactions"]:
-        transaction = dict(transaction)
-        if "date" in transaction:
-            date = transaction["date"]
-            if date is None:
-                date_str = None
-            elif isinstance(date, datetime.date):
-                date_str = date.strftime(DATE_FORMAT)
-            elif isinstance(date, datetime.datetime):
-                date_str = date.strftime(DATETIME_FORMAT)
+### JSON backends
+
+class StdlibBackend:
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, pretty):
+        if pretty:
+            return json.dumps(obj, indent=2)
+        return json.dumps(obj, separators=(",", ":"))
+
+class OrjsonBackend:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+    def dumps(self, obj, pretty):
+        option = self.orjson.OPT_INDENT_2 if pretty else 0
+        return self.orjson.dumps(obj, option=option).decode()
+
+class UjsonBackend:
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+    def dumps(self, obj, pretty):
+        if pretty:
+            return self.ujson.dumps(
+                obj, indent=2, escape_forward_slashes=False)
+        return self.ujson.dumps(obj, escape_forward_slashes=False)
+
+# In order of preference for the "auto" backend.
+JSON_BACKENDS = {
+    "orjson": OrjsonBackend,
+    "ujson": UjsonBackend,
+    "json": StdlibBackend,
+}
+
+def load_json_backend(name):
+    if name == "auto":
+        for backend in JSON_BACKENDS.values():
+            try:
+                return backend()
+            except ImportError:
+                continue
+    if name not in JSON_BACKENDS:
+        raise UserDataError("unknown JSON backend: {}".format(name))
+    try:
+        return JSON_BACKENDS[name]()
+    except ImportError:
+        raise ExternalCommandError(
+            "JSON backend {} is not installed".format(repr(name)))
+
+### Layouts
+
+LEDGER_FORMATS = ("pretty", "compact")
+
+class LedgerCodec:
+    # Converts ledgers to and from text. The "pretty" format is
+    # indented JSON, for ledgers meant to be read and diffed by
+    # humans. The "compact" format has no indentation, but puts each
+    # transaction on its own line (so that it can still be indexed
+    # and read from the end quickly, see LedgerReader).
+
+    def __init__(self, backend=None, format="pretty"):
+        if backend is None:
+            backend = StdlibBackend()
+        if format not in LEDGER_FORMATS:
+            raise UserDataError("unknown ledger format: {}".format(format))
+        self.backend = backend
+        self.format = format
+        # Backends escape strings and format numbers differently, so
+        # the pretty format is always written by the standard library,
+        # so that its bytes (and hence Git diffs) do not depend on
+        # which backend is installed.
+        self.pretty_backend = StdlibBackend()
+
+    def loads(self, data):
+        return self.backend.loads(data)
+
+    def dumps_transaction(self, transaction):
+        # Format a (serialized) transaction as it appears inside the
+        # transactions list.
+        if self.format == "pretty":
+            text = self.pretty_backend.dumps(transaction, pretty=True)
+            return "\n".join("    " + line for line in text.split("\n"))
+        return self.backend.dumps(transaction, pretty=False)
+
+    def dumps(self, ledger):
+        if self.format == "pretty":
+            return self.pretty_backend.dumps(ledger, pretty=True)
+        parts = []
+        for key, value in ledger.items():
+            if key == "transactions" and value:
+                value_str = "[\n{}\n]".format(",\n".join(
+                    self.dumps_transaction(transaction)
+                    for transaction in value))
             else:
-                raise InternalError(
-                    "cannot serialize date of type {}: {}"
-                    .format(repr(type(date)), repr(date)))
-            transaction["date"] = date_str
-        transactions.append(transaction)
+                value_str = self.backend.dumps(value, pretty=False)
+            parts.append(self.backend.dumps(key, pretty=False) + ":" + value_str)
+        return "{" + ",".join(parts) + "}"
+
+DEFAULT_CODEC = LedgerCodec()
+
+def ledger_codec(io):
+    # The codec selected by the configuration of the current command.
+    config = getattr(io, "config", None) or {}
+    return LedgerCodec(load_json_backend(config.get("json-backend", "auto")),
+                       config.get("ledger-format", "pretty"))
+
+### Ledgers
+
+def serialize_ledger(ledger, codec=DEFAULT_CODEC):
     ledger = dict(ledger)
-    ledger["transactions"] = transactions
-    return json.dumps(ledger, indent=2)
+    ledger["transactions"] = [
+        serialize_transaction(transaction)
+        for transaction in ledger["transactions"]]
+    return codec.dumps(ledger)
 
-def deserialize_ledger(ledger_json):
+def deserialize_ledger(ledger_json, codec=DEFAULT_CODEC):
     try:
-        ledger = json.loads(ledger_json)
-    except json.decoder.JSONDecodeError as e:
+        ledger = codec.loads(ledger_json)
+    except ValueError as e:
         raise UserDataError("malformed JSON: {}".format(str(e)))
     for transaction in ledger["transactions"]:
-        if "date" in transaction:
-            date = transaction["date"]
+        deserialize_transaction(transaction)
+    return ledger
+
+## Random access
+### Indexing
+
+# Matches a JSON string (optionally used as a map key, in which case
+# the colon and any whitespace around it are included in group 2) or
+# a structural bracket. Everything else in a JSON document is either
+# whitespace, a comma, or a scalar that cannot contain these
+# characters, so scanning these tokens is enough to track nesting.
+JSON_TOKEN_RE = re.compile(rb'("(?:[^"\\]|\\.)*")(\s*:\s*)?|[][{}]')
+
+METADATA_KEY = b'"metadata"'
+TRANSACTIONS_KEY = b'"transactions"'
+ID_KEY = b'"id"'
+
+class LedgerLayout:
+    # Byte patterns that delimit the transactions in a ledger written
+    # by LedgerCodec in the given format. JSON strings cannot contain
+    # raw newlines, so none of these patterns (all of which start with
+    # a newline, except the key) can match inside a string.
+
+    def __init__(self, format, transactions_key, element_start,
+                 array_end, trailer, id_re):
+        # The key as it appears just before the opening bracket of the
+        # transactions list.
+        self.format = format
+        self.transactions_key = transactions_key
+        # Precedes the opening brace of each transaction (and nothing
+        # else) within the transactions list.
+        self.element_start = element_start
+        # Precedes the closing bracket of the transactions list.
+        self.array_end = array_end
+        # What is left of the file after the transactions list if it
+        # is the last key, ignoring trailing whitespace.
+        self.trailer = trailer
+        # Matches the ID of a transaction, if it has one, at the top
+        # level of the transaction map. For the compact format this
+        # only works if the ID comes first.
+        self.id_re = id_re
+
+PRETTY_LAYOUT = LedgerLayout(
+    "pretty", b'\n  "transactions": ', b"\n    {", b"\n  ]", b"\n}",
+    re.compile(rb'\n      "id": ("(?:[^"\\]|\\.)*")'))
+
+COMPACT_LAYOUT = LedgerLayout(
+    "compact", b'"transactions":', b"\n{", b"\n]", b"}",
+    re.compile(rb'\n\{"id":("(?:[^"\\]|\\.)*")'))
+
+LAYOUTS = (PRETTY_LAYOUT, COMPACT_LAYOUT)
+
+def detect_layout(data, array_start):
+    # Return the layout of the transactions list starting at the given
+    # offset, or None if it was not written by LedgerCodec.
+    for layout in LAYOUTS:
+        key = layout.transactions_key
+        if data[array_start - len(key):array_start] != key:
+            continue
+        if data[array_start:array_start + 2] == b"[]":
+            return layout
+        element_end = array_start + 1 + len(layout.element_start)
+        if data[array_start + 1:element_end] == layout.element_start:
+            return layout
+    return None
+
+def scan_ledger_header(data):
+    # Return the spans of the metadata map and the position of the
+    # opening bracket of the transactions list, scanning only as far
+    # as that bracket. Either may be None if not found.
+    depth = 0
+    key = None
+    metadata_start = None
+    metadata = None
+    for m in JSON_TOKEN_RE.finditer(data):
+        if m.group(1) is not None:
+            if depth == 1 and m.group(2):
+                key = m.group(1)
+            continue
+        char = data[m.start()]
+        if char in b"{[":
+            depth += 1
+            if depth == 2:
+                if key == TRANSACTIONS_KEY and char == ord("["):
+                    return metadata, m.start()
+                if key == METADATA_KEY and char == ord("{"):
+                    metadata_start = m.start()
+        else:
+            if depth == 2 and metadata_start is not None and metadata is None:
+                metadata = [metadata_start, m.end()]
+            depth -= 1
+    return metadata, None
+
+def iter_layout_spans(data, layout, array_start, array_end,
+                      position=None, reverse=False):
+    # Yield the spans of the transactions in a (non-empty) list
+    # written in the given layout, which opens at array_start and
+    # whose closing pattern begins at array_end. Goes forwards from
+    # the first transaction at or after the given offset, or
+    # backwards from the last transaction. Only the patterns of the
+    # layout are looked for, so nothing else has to be scanned.
+    element_start = layout.element_start
+    if reverse:
+        position = data.rfind(element_start, array_start, array_end)
+        next_position = -1
+    else:
+        if position is None:
+            position = array_start
+        position = data.find(element_start, position, array_end)
+    while position != -1:
+        start = position + len(element_start) - 1
+        if not reverse:
+            next_position = data.find(element_start, position + 1, array_end)
+        # Each transaction but the last is followed by a comma and then
+        # the pattern that begins the next one.
+        end = array_end if next_position == -1 else next_position - 1
+        # A hand-edited file can look like the layout without following
+        # it exactly, so give up unless every span ends a map.
+        if data[end - 1] != ord("}"):
+            raise UserDataError(
+                "transaction at byte {} does not follow the {} format"
+                .format(start, layout.format))
+        yield start, end
+        if reverse:
+            position, next_position = data.rfind(
+                element_start, array_start, position), position
+        else:
+            position = next_position
+
+def index_layout_transactions(data, array_start, layout):
+    # Fast path for ledgers written by LedgerCodec, which only looks
+    # for the patterns given by the layout.
+    if data[array_start:array_start + 2] == b"[]":
+        return [array_start, array_start + 2], [], [], []
+    array_end = data.find(layout.array_end, array_start)
+    if array_end == -1:
+        return None
+    try:
+        spans = list(iter_layout_spans(data, layout, array_start, array_end))
+    except UserDataError:
+        return None
+    starts = [start for start, end in spans]
+    ends = [end for start, end in spans]
+    ids = [None] * len(starts)
+    matches = list(layout.id_re.finditer(data, array_start, array_end))
+    values = json.loads(b"[" + b",".join(m.group(1) for m in matches) + b"]")
+    for m, value in zip(matches, values):
+        # The compact pattern begins before the opening brace, so place
+        # each ID by where its value starts.
+        ids[bisect.bisect_right(starts, m.start(1)) - 1] = value
+    for idx, transaction_id in enumerate(ids):
+        if transaction_id is None:
             try:
-                if is_datetime(date):
-                    date = datetime.datetime.strptime(date, DATETIME_FORMAT)
-                else:
-                    date = datetime.datetime.strptime(date, DATE_FORMAT).date()
+                transaction = json.loads(data[starts[idx]:ends[idx]])
             except ValueError:
-                raise UserDataError("malformed date: {}".format(date))
-            transaction["date"] = date
-    return ledger
+                return None
+            if isinstance(transaction, dict):
+                ids[idx] = transaction.get("id")
+    return [array_start, array_end + len(layout.array_end)], starts, ends, ids
+
+def index_transactions(data):
+    # Generic scan over every structural token in the file.
+    depth = 0
+    key = None
+    container = None
+    container_start = None
+    metadata = None
+    array = None
+    starts, ends, ids = [], [], []
+    id_value_start = None
+    for m in JSON_TOKEN_RE.finditer(data):
+        if m.group(1) is not None:
+            if m.group(2):
+                if depth == 1:
+                    key = m.group(1)
+                elif (depth == 3 and container == TRANSACTIONS_KEY and
+                      m.group(1) == ID_KEY):
+                    id_value_start = m.end()
+            elif m.start() == id_value_start:
+                ids[-1] = json.loads(m.group(1))
+            continue
+        char = data[m.start()]
+        if char in b"{[":
+            depth += 1
+            if depth == 2:
+                container = key
+                container_start = m.start()
+            elif (depth == 3 and container == TRANSACTIONS_KEY and
+                  array is None and char == ord("{")):
+                starts.append(m.start())
+                ids.append(None)
+        else:
+            if (depth == 3 and container == TRANSACTIONS_KEY and
+                array is None and char == ord("}")):
+                ends.append(m.end())
+            elif depth == 2:
+                span = [container_start, m.end()]
+                if container == TRANSACTIONS_KEY and char == ord("]"):
+                    array = array or span
+                elif container == METADATA_KEY and char == ord("}"):
+                    metadata = metadata or span
+                container = None
+            depth -= 1
+    return metadata, array, starts, ends, ids
+
+# Name of the FileCache holding the results of build_ledger_index,
+# which changes whenever they do, so that stale entries are not used.
+LEDGER_INDEX_CACHE = "ledger-index-2"
+
+def build_ledger_index(data):
+    # Locate the metadata map and every transaction map in a ledger
+    # file (bytes or mmap), returning their byte spans together with
+    # the transaction IDs. The result is JSON-serializable so that it
+    # can be persisted with FileCache.
+    metadata, array_start = scan_ledger_header(data)
+    result = None
+    if metadata is not None and array_start is not None:
+        layout = detect_layout(data, array_start)
+        if layout is not None:
+            result = index_layout_transactions(data, array_start, layout)
+        if result is not None:
+            result = (metadata,) + result
+    if result is None:
+        result = index_transactions(data)
+    metadata, array, starts, ends, ids = result
+    if array is None:
+        raise UserDataError("no list of transactions found")
+    if len(starts) != len(ends):
+        raise UserDataError("malformed JSON: unbalanced transaction maps")
+    return {
+        "metadata": metadata,
+        "transactions": array,
+        "starts": starts,
+        "ends": ends,
+        "ids": ids,
+    }
+
+### Reading
+
+def map_file(f, size):
+    # Memory-map an open binary file for reading. Empty files cannot
+    # be mapped, so they are represented by empty bytes instead.
+    if not size:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class LedgerReader:
+    # Random access to the transactions of a ledger file. The file is
+    # memory-mapped and only the transactions that are asked for are
+    # decoded (with the same date handling as deserialize_ledger), so
+    # the rest of the file is never copied out of the page cache. The
+    # offset index is persisted in the given FileCache, if any. If
+    # lazy is true, the index is only built once it is needed, so that
+    # reading just the metadata and the tail costs the same for any
+    # size of ledger.
+
+    def __init__(self, path, io, cache=None, codec=None, lazy=False):
+        self.path = path
+        self.codec = codec or ledger_codec(io)
+        self.cache = cache
+        self.index = None
+        try:
+            self.file = io.open(path, "rb")
+        except OSError as e:
+            raise FilesystemError("could not read file {}: {}"
+                                  .format(repr(path), str(e)))
+        try:
+            self.data = map_file(self.file, io.stat(path).st_size)
+            io_metrics(io).count("bytes-mapped", len(self.data))
+        except OSError as e:
+            self.close()
+            raise FilesystemError("could not read file {}: {}"
+                                  .format(repr(path), str(e)))
+        if not lazy:
+            try:
+                self.load_index()
+            except BaseException:
+                self.close()
+                raise
+        self.positions = None
+
+    def load_index(self):
+        if self.index is None:
+            try:
+                if self.cache is not None:
+                    self.index = self.cache.get(self.path, build_ledger_index)
+                else:
+                    self.index = build_ledger_index(self.data)
+            except Failure as e:
+                raise type(e)("in file {}: {}".format(repr(self.path), str(e)))
+            except (OSError, ValueError) as e:
+                raise FilesystemError("could not read file {}: {}"
+                                      .format(repr(self.path), str(e)))
+        return self.index
+
+    def close(self):
+        if isinstance(getattr(self, "data", None), mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.load_index()["starts"])
+
+    def decode(self, start, end):
+        try:
+            return self.codec.loads(self.data[start:end])
+        except ValueError as e:
+            raise UserDataError("in file {}: malformed JSON: {}"
+                                .format(repr(self.path), str(e)))
+
+    def metadata(self):
+        if self.index is not None:
+            span = self.index["metadata"]
+        else:
+            span, array_start = scan_ledger_header(self.data)
+        if span is None:
+            return None
+        return self.decode(*span)
+
+    def decode_transaction(self, start, end):
+        try:
+            return deserialize_transaction(self.decode(start, end))
+        except Failure as e:
+            raise type(e)("in file {}: {}".format(repr(self.path), str(e)))
+
+    def transaction(self, idx):
+        index = self.load_index()
+        return self.decode_transaction(index["starts"][idx], index["ends"][idx])
+
+    def transactions(self, start=None, stop=None):
+        return [self.transaction(idx)
+                for idx in range(*slice(start, stop).indices(len(self)))]
+
+    def find_tail(self, count):
+        # Locate the last count transactions by scanning backwards from
+        # the end of the file, which works if it was written by
+        # LedgerCodec with the transactions as the last key. Returns a
+        # map with keys layout, end (where the closing pattern of the
+        # transactions list begins) and spans, or None if the file
+        # does not have a known layout or has no transactions.
+        data = self.data
+        metadata, array_start = scan_ledger_header(data)
+        if metadata is None or array_start is None:
+            return None
+        layout = detect_layout(data, array_start)
+        if layout is None or data[array_start:array_start + 2] == b"[]":
+            return None
+        array_end = data.rfind(layout.array_end, array_start)
+        if array_end == -1:
+            return None
+        if data[array_end + len(layout.array_end):].rstrip() != layout.trailer:
+            return None
+        try:
+            spans = list(itertools.islice(iter_layout_spans(
+                data, layout, array_start, array_end, reverse=True), count))
+        except UserDataError:
+            return None
+        spans.reverse()
+        return {
+            "layout": layout,
+            "end": array_end,
+            "spans": spans,
+        }
+
+    def tail(self, count):
+        if self.index is None:
+            tail = self.find_tail(count)
+            if tail is not None:
+                return [self.decode_transaction(start, end)
+                        for start, end in tail["spans"]]
+        return self.transactions(max(len(self) - count, 0))
+
+    def transaction_date(self, idx):
+        date = self.transaction(idx).get("date")
+        if not isinstance(date, datetime.date):
+            raise UserDataError("in file {}: transaction {} has no date"
+                                .format(repr(self.path), idx))
+        if isinstance(date, datetime.datetime):
+            return date.date()
+        return date
+
+    def bisect_date(self, date):
+        # Return the index of the first transaction dated on or after
+        # the given date, assuming that the ledger is sorted by date.
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.transaction_date(middle) < date:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def date_range(self, start=None, end=None):
+        # Return the range of indices of the transactions dated from
+        # start up to but not including end (either of which can be
+        # None for no bound), for a ledger that is sorted by date, as
+        # imported ledgers are. Only the transactions that the
+        # bisection lands on are decoded.
+        first = 0 if start is None else self.bisect_date(start)
+        stop = len(self) if end is None else self.bisect_date(end)
+        return range(first, max(first, stop))
+
+    def position(self, transaction_id):
+        if self.positions is None:
+            self.positions = {}
+            for idx, tid in enumerate(self.load_index()["ids"]):
+                self.positions.setdefault(tid, idx)
+        return self.positions.get(transaction_id)
+
+    def find(self, transaction_id):
+        idx = self.position(transaction_id)
+        if idx is None:
+            return None
+        return self.transaction(idx)
+
+## Importer support
+### CSV rows
+
+def iter_csv_rows(data, offset=0):
+    # Yield each row of the CSV data (bytes) starting at the given
+    # byte offset, together with the byte offset just past the end of
+    # that row. The reader only pulls as many lines as it needs for
+    # each row, so the offset stays accurate for quoted multiline
+    # fields.
+    position = offset
+    def lines():
+        nonlocal position
+        for line in data[offset:].splitlines(keepends=True):
+            position += len(line)
+            yield line.decode()
+    for row in csv.reader(lines()):
+        yield row, position
+
+### Checkpoints
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def import_checkpoint_path(json_path):
+    return json_path + CHECKPOINT_SUFFIX
+
+def load_import_checkpoint(data, json_path, metadata, io):
+    # Return the previously imported ledger and the checkpoint that
+    # was recorded alongside it, or None if a full import is needed
+    # (no checkpoint, the CSV prefix changed, or the ledger was edited
+    # since it was imported).
+    checkpoint_path = import_checkpoint_path(json_path)
+    if not io.isfile(checkpoint_path) or not io.isfile(json_path):
+        return None
+    try:
+        with io.open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        offset = checkpoint["offset"]
+        rows = checkpoint["rows"]
+        source_hash = checkpoint["source-sha256"]
+        ledger_hash = checkpoint["ledger-sha256"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(offset, int) or not 0 <= offset <= len(data):
+        return None
+    if not isinstance(rows, int) or rows < 0:
+        return None
+    # Checkpoints from before importers could record their own state.
+    if "state" not in checkpoint:
+        return None
+    if sha256_hex(data[:offset]) != source_hash:
+        return None
+    if offset > 0 and data[offset - 1:offset] not in (b"\n", b"\r"):
+        # The last imported row had no line terminator. If rows were
+        # appended since, it has gained one, which must be skipped so
+        # it doesn't read as an empty row; anything else means that
+        # row itself was extended, so it can't be resumed.
+        if data[offset:offset + 2] == b"\r\n":
+            offset += 2
+        elif data[offset:offset + 1] in (b"\n", b"\r"):
+            offset += 1
+        elif offset < len(data):
+            return None
+        checkpoint = dict(checkpoint, offset=offset)
+    try:
+        with io.open(json_path, "rb") as f:
+            ledger_bytes = f.read()
+    except OSError as e:
+        raise FilesystemError("could not read file {}: {}"
+                              .format(repr(json_path), str(e)))
+    if sha256_hex(ledger_bytes) != ledger_hash:
+        return None
+    try:
+        ledger = deserialize_ledger(ledger_bytes, ledger_codec(io))
+    except Failure as e:
+        raise type(e)("in file {}: {}".format(repr(json_path), str(e)))
+    if ledger["metadata"] != metadata:
+        return None
+    return ledger, checkpoint
+
+def save_import_checkpoint(data, offset, rows, state, ledger_str, json_path,
+                           writes):
+    # Stage the checkpoint in the WriteBatch that holds the ledger, so
+    # that it is never replaced before the ledger. The state is any
+    # JSON value the importer needs to resume (or None).
+    checkpoint_path = import_checkpoint_path(json_path)
+    checkpoint = {
+        "offset": offset,
+        "rows": rows,
+        "state": state,
+        "source-sha256": sha256_hex(data[:offset]),
+        "ledger-sha256": sha256_hex((ledger_str + "\n").encode()),
+    }
+    try:
+        with writes.open(checkpoint_path) as f:
+            json.dump(checkpoint, f, indent=2)
+            f.write("\n")
+    except OSError as e:
+        raise FilesystemError(
+            "could not write file {}: {}".format(repr(checkpoint_path), str(e)))
+
+### Running imports
+
+def run_csv_import(csv_path, json_path, metadata, read_rows, incremental, io):
+    # Import the CSV file into the ledger, resuming from the checkpoint
+    # if the import is incremental. read_rows is called as
+    # read_rows(data, offset, rows, id_scheme, state) and returns the
+    # parsed transactions together with the offset, row count and
+    # state to record in the next checkpoint. The state is None unless
+    # resuming, in which case it is what read_rows returned last time.
+    try:
+        with io.open(csv_path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise FilesystemError(
+            "could not read file {}: {}".format(repr(csv_path), str(e)))
+    resumed = None
+    if incremental:
+        resumed = load_import_checkpoint(data, json_path, metadata, io)
+    if resumed:
+        ledger, checkpoint = resumed
+        offset, rows = checkpoint["offset"], checkpoint["rows"]
+        state = checkpoint["state"]
+    else:
+        ledger = {
+            "metadata": metadata,
+            "transactions": [],
+        }
+        offset, rows, state = 0, 0, None
+    metrics = io_metrics(io)
+    start_rows = rows
+    with metrics.phase("parse"):
+        transactions, offset, rows, state = read_rows(
+            data, offset, rows, id_scheme(io), state)
+    metrics.count("rows-parsed", rows - start_rows)
+    ledger["transactions"].extend(transactions)
+    with metrics.phase("serialize"):
+        ledger_str = serialize_ledger(ledger, ledger_codec(io))
+    json_dir = io.dirname(io.abspath(json_path))
+    try:
+        io.makedirs(json_dir, exist_ok=True)
+    except OSError as e:
+        raise FilesystemError(
+            "could not create directory {}: {}".format(repr(json_dir), str(e)))
+    with staged_writes(io) as writes:
+        try:
+            with writes.open(json_path) as f:
+                f.write(ledger_str)
+                f.write("\n")
+        except OSError as e:
+            raise FilesystemError(
+                "could not write file {}: {}".format(repr(json_path), str(e)))
+        if incremental:
+            save_import_checkpoint(
+                data, offset, rows, state, ledger_str, json_path, writes)
+
+## Caching
+
+def cache_directory(io):
+    base = io.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = io.join(io.expanduser("~"), ".cache")
+    return io.join(base, "acc")
+
+def compute_cache_entry(data, compute, known_digest):
+    # Return the hash of the data and the value computed from it,
+    # which is None (and not computed) if the hash is already known.
+    digest = sha256_hex(data)
+    if digest == known_digest:
+        return digest, None
+    return digest, compute(data)
+
+def compute_file_cache_entry(path, compute, known_digest):
+    # Like compute_cache_entry, for worker processes, which open the
+    # file themselves.
+    with open(path, "rb") as f:
+        data = f.read()
+    return compute_cache_entry(data, compute, known_digest)
+
+class FileCache:
+    # Persistent cache of values derived from file contents, keyed by
+    # absolute path. Each entry is stored in its own file, so only the
+    # entries that are used get loaded. An entry is reused without
+    # reading the file when its size and mtime are unchanged, and
+    # after rehashing the file when only the mtime changed (for
+    # example after a Git checkout). Values must be JSON-serializable.
+
+    def __init__(self, name, io):
+        self.io = io
+        self.directory = io.join(cache_directory(io), name)
+        self.entries = {}
+        self.dirty = set()
+
+    def entry_path(self, path):
+        return self.io.join(self.directory, sha256_hex(path.encode()) + ".json")
+
+    def load_entry(self, path):
+        try:
+            with self.io.open(self.entry_path(path)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("path") != path:
+            return None
+        return entry
+
+    def get(self, path, compute):
+        path = self.io.abspath(path)
+        stat = self.io.stat(path)
+        if path not in self.entries:
+            self.entries[path] = self.load_entry(path)
+        entry = self.entries[path]
+        if (entry and entry["size"] == stat.st_size and
+            entry["mtime"] == stat.st_mtime_ns):
+            return entry["value"]
+        with self.io.open(path, "rb") as f:
+            data = f.read()
+        digest = sha256_hex(data)
+        if not entry or entry["sha256"] != digest:
+            entry = {"path": path, "sha256": digest, "value": compute(data)}
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime_ns
+        self.entries[path] = entry
+        self.dirty.add(path)
+        return entry["value"]
+
+    def get_many(self, paths, compute, jobs=1):
+        # Like get for each of the paths, returning a list of values,
+        # except that the files whose entries are stale are read and
+        # hashed (and their values computed, if needed) by a pool of
+        # the given number of worker processes. compute and its
+        # results must then be picklable.
+        paths = [self.io.abspath(path) for path in paths]
+        stale = []
+        for path in dict.fromkeys(paths):
+            stat = self.io.stat(path)
+            if path not in self.entries:
+                self.entries[path] = self.load_entry(path)
+            entry = self.entries[path]
+            if not (entry and entry["size"] == stat.st_size and
+                    entry["mtime"] == stat.st_mtime_ns):
+                stale.append((path, stat, entry))
+        requests = [(path, compute, entry["sha256"] if entry else None)
+                    for path, stat, entry in stale]
+        if jobs > 1 and len(requests) > 1:
+            workers = min(jobs, len(requests))
+            io_metrics(self.io).count("subprocesses", workers)
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                results = list(executor.map(
+                    compute_file_cache_entry, *zip(*requests)))
+        else:
+            results = []
+            for path, compute, digest in requests:
+                with self.io.open(path, "rb") as f:
+                    data = f.read()
+                results.append(compute_cache_entry(data, compute, digest))
+        for (path, stat, entry), (digest, value) in zip(stale, results):
+            if not entry or entry["sha256"] != digest:
+                entry = {"path": path, "sha256": digest, "value": value}
+            entry["size"] = stat.st_size
+            entry["mtime"] = stat.st_mtime_ns
+            self.entries[path] = entry
+            self.dirty.add(path)
+        return [self.entries[path]["value"] for path in paths]
+
+    def save(self):
+        # The cache is only an optimization, so failing to write it
+        # is not an error.
+        for path in sorted(self.dirty):
+            entry_path = self.entry_path(path)
+            temp_path = entry_path + ".tmp"
+            try:
+                self.io.makedirs(self.directory, exist_ok=True)
+                with self.io.open(temp_path, "w") as f:
+                    json.dump(self.entries[path], f)
+                self.io.replace(temp_path, entry_path)
+            except OSError:
+                continue
+        self.dirty = set()
+
+## Writing
+
+# Buffer size of files written through a WriteBatch, so that streamed
+# output reaches the disk in large chunks.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+TEMP_SUFFIX = ".tmp"
+
+class StagedFile:
+    # A file being written by a WriteBatch. Closing it flushes it to
+    # disk, but it only replaces its target when the batch commits.
+
+    def __init__(self, file, io):
+        self.file = file
+        self.io = io
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            self.io.fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class WriteBatch:
+    # Files written during one command. Each file is written to a
+    # temporary file with a unique name next to its target (following
+    # symlinks, so that the file they point to is the one replaced),
+    # which is given the mode of the target, and only when the batch is
+    # committed are they renamed over their targets, one at a time and
+    # in the order they were opened. A failure (or crash) before that
+    # point leaves every target untouched, and each target is always
+    # either the old or the new file, but a crash during the commit can
+    # leave some targets replaced and others not.
+
+    def __init__(self, io):
+        self.io = io
+        self.staged = {}
+        self.callbacks = []
+
+    def open(self, path, mode="w"):
+        # Return a file to write the new contents of path to. Opening
+        # the same path again discards what was written before.
+        path = self.io.realpath(path)
+        if path in self.staged:
+            self.discard(path)
+        fd, temp_path = self.io.mkstemp(
+            dir=self.io.dirname(path),
+            prefix=self.io.basename(path) + ".", suffix=TEMP_SUFFIX)
+        try:
+            file = self.io.open(fd, mode, buffering=WRITE_BUFFER_SIZE)
+        except BaseException:
+            self.io.close_fd(fd)
+            self.io.remove(temp_path)
+            raise
+        self.staged[path] = (temp_path, StagedFile(file, self.io))
+        return self.staged[path][1]
+
+    def after_commit(self, callback):
+        # Call the function once the batch has been committed, for
+        # cleanup that is only safe once the new files are in place.
+        self.callbacks.append(callback)
+
+    def discard(self, path):
+        temp_path, file = self.staged.pop(path)
+        file.file.close()
+        if self.io.exists(temp_path):
+            self.io.remove(temp_path)
+
+    def commit(self):
+        directories = []
+        for temp_path, file in self.staged.values():
+            file.close()
+        for path, (temp_path, file) in self.staged.items():
+            # New files get the mode that open() would have given them.
+            if self.io.exists(path):
+                file_mode = stat.S_IMODE(self.io.stat(path).st_mode)
+            else:
+                file_mode = self.io.default_file_mode()
+            self.io.chmod(temp_path, file_mode)
+            self.io.replace(temp_path, path)
+            directory = self.io.dirname(path)
+            if directory not in directories:
+                directories.append(directory)
+        for directory in directories:
+            self.io.fsync_directory(directory)
+        self.staged = {}
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def abort(self):
+        for path in list(self.staged):
+            self.discard(path)
+        self.callbacks = []
+
+@contextlib.contextmanager
+def staged_writes(io):
+    # The WriteBatch of the current command, which is committed once
+    # the command has succeeded. IO objects without one get a batch
+    # that is committed at the end of the with block instead.
+    batch = getattr(io, "writes", None)
+    if batch is not None:
+        yield batch
+        return
+    batch = WriteBatch(io)
+    try:
+        yield batch
+    except BaseException:
+        batch.abort()
+        raise
+    batch.commit()
+
+## Library
+
+LEDGER_EXTENSION = ".json"
+
+def library_root(io):
+    config_file = locate_dominating_file("config.json", io)
+    if config_file is None:
+        return io.getcwd()
+    return io.dirname(config_file)
+
+def find_library_files(io, root=None):
+    # Return the paths of all candidate ledger files in the library,
+    # skipping the config file, hidden directories and exports.
+    if root is None:
+        root = library_root(io)
+    paths = []
+    for directory, subdirs, filenames in io.walk(root):
+        if (EXPORT_MANIFEST in filenames and
+            load_export_manifest(directory, io) is not None):
+            subdirs[:] = []
+            continue
+        subdirs[:] = sorted(d for d in subdirs if not d.startswith("."))
+        for filename in sorted(filenames):
+            if not filename.endswith(LEDGER_EXTENSION):
+                continue
+            if directory == root and filename == "config.json":
+                continue
+            paths.append(io.join(directory, filename))
+    return paths
+
+def ledger_name(path, root, io):
+    name = io.relpath(io.abspath(path), io.abspath(root))
+    if name.endswith(LEDGER_EXTENSION):
+        name = name[:-len(LEDGER_EXTENSION)]
+    return name
 
 ## Subcommands
+
+def parse_ledger_jobs_args(args, subcommand, io):
+    # Parse the arguments of a subcommand taking [--jobs <n>] [--]
+    # [<ledger>...], returning the ledger files and the number of jobs
+    # (by default, one per CPU).
+    ledger_files = []
+    jobs = None
+    args_done = False
+    while args:
+        if not args_done:
+            if args[0] == "--":
+                args_done = True
+                args = args[1:]
+                continue
+            if args[0] == "--jobs":
+                if len(args) == 1:
+                    raise usage_error(subcommand)
+                try:
+                    jobs = int(args[1])
+                except ValueError:
+                    raise usage_error(subcommand)
+                if jobs < 1:
+                    raise usage_error(subcommand)
+                args = args[2:]
+                continue
+            if args[0].startswith("-"):
+                raise usage_error(subcommand)
+        ledger_files.append(args[0])
+        args = args[1:]
+    if jobs is None:
+        jobs = io.cpu_count() or 1
+    return ledger_files, jobs
+
 ### init
 
 def subcommand_init(args, io, using_git, **kwargs):
@@ -244,7 +1504,7 @@ def subcommand_init(args, io, using_git, **kwargs):
     config_file = io.join(path, "config.json")
     config = load_config_file(None, io)
     try:
-        with open(config_file, "w") as f:
+        with staged_writes(io) as writes, writes.open(config_file) as f:
             json.dump(config, f, indent=2)
             f.write("\n")
     except OSError as e:
@@ -292,6 +1552,8 @@ def most_similar_transaction(transaction, transactions):
                key=lambda t: transaction_similarity(t, transaction))
 
 def transactions_equivalent(t1, t2):
+    if t1 == t2:
+        return True
     t1_norm, t2_norm = dict(t1), dict(t2)
     del t1_norm["id"]
     del t2_norm["id"]
@@ -309,6 +1571,54 @@ def diff_maps(m1, m2, exclude_keys=[]):
                     .format(repr(key), repr(v1), repr(v2)))
     return None
 
+def diff_all_maps(m1, m2, exclude_keys=[]):
+    # Like diff_maps, but return every differing key (in sorted order)
+    # together with both values.
+    differences = []
+    for key in sorted(set(m1) | set(m2)):
+        if key in exclude_keys:
+            continue
+        v1, v2 = m1.get(key, UNSET), m2.get(key, UNSET)
+        if v1 != v2:
+            differences.append((key, v1, v2))
+    return differences
+
+def check_metadata_matches(source_metadata, target_metadata):
+    metadata_diff = diff_maps(source_metadata, target_metadata)
+    if metadata_diff:
+        raise UserDataError("source and target ledger metadata {}"
+                            .format(metadata_diff))
+
+def find_alignment(base_transaction, target_transactions):
+    # With content-derived IDs the same transaction has the same ID in
+    # both ledgers, so look for it by ID first. This is cheap, and
+    # avoids aligning on a different transaction that merely has the
+    # same contents.
+    base_id = base_transaction.get("id")
+    for target_idx, target_transaction in enumerate(target_transactions):
+        if (target_transaction.get("id") == base_id and
+            transactions_equivalent(base_transaction, target_transaction)):
+            return target_idx
+    for target_idx, target_transaction in enumerate(target_transactions):
+        if transactions_equivalent(base_transaction, target_transaction):
+            return target_idx
+    return None
+
+def check_alignment(source_transactions, target_transactions, target_idx):
+    for source_transaction, target_transaction in zip(
+            source_transactions, target_transactions[target_idx:]):
+        if source_transaction == target_transaction:
+            continue
+        align_diff = diff_maps(
+            source_transaction, target_transaction, exclude_keys=["id"])
+        if align_diff:
+            raise UserDataError(
+                ("ledgers do not align; transactions in source "
+                 "({}) and target ({}) {}")
+                .format(repr(source_transaction["id"]),
+                        repr(target_transaction["id"]),
+                        align_diff))
+
 def merge_ledgers(source_ledger, target_ledger, require_overlap):
 
     # If target ledger does not exist, just copy the source ledger.
@@ -322,10 +1632,7 @@ def merge_ledgers(source_ledger, target_ledger, require_overlap):
     target_transactions = target_ledger["transactions"]
 
     # Ensure that metadata matches.
-    metadata_diff = diff_maps(source_metadata, target_metadata)
-    if metadata_diff:
-        raise UserDataError("source and target ledger metadata {}"
-                            .format(metadata_diff))
+    check_metadata_matches(source_metadata, target_metadata)
 
     # If no transactions in target ledger, just copy the source ledger.
     if not target_transactions:
@@ -338,11 +1645,8 @@ def merge_ledgers(source_ledger, target_ledger, require_overlap):
     # Get the location of the first transaction from the source ledger
     # within the target ledger.
     base_transaction = source_transactions[0]
-    found_alignment = False
-    for target_idx, target_transaction in enumerate(target_transactions):
-        if transactions_equivalent(base_transaction, target_transaction):
-            found_alignment = True
-            break
+    target_idx = find_alignment(base_transaction, target_transactions)
+    found_alignment = target_idx is not None
 
     if require_overlap:
         # If no alignment, report an error.
@@ -359,17 +1663,7 @@ def merge_ledgers(source_ledger, target_ledger, require_overlap):
                         most_similar_diff))
 
         # Ensure alignment continues.
-        for source_transaction, target_transaction in zip(
-                source_transactions, target_transactions[target_idx:]):
-            align_diff = diff_maps(
-                source_transaction, target_transaction, exclude_keys=["id"])
-            if align_diff:
-                raise UserDataError(
-                    ("ledgers do not align; transactions in source "
-                     "({}) and target ({}) {}")
-                    .format(repr(source_transaction["id"]),
-                            repr(target_transaction["id"]),
-                            align_diff))
+        check_alignment(source_transactions, target_transactions, target_idx)
 
     # Create merged ledger.
     #
@@ -379,12 +1673,327 @@ def merge_ledgers(source_ledger, target_ledger, require_overlap):
     # source_idx = 2
     merged_ledger = copy.deepcopy(target_ledger)
     if found_alignment:
-        source_idx = len(source_transactions) - target_idx
+        source_idx = len(target_transactions) - target_idx
     else:
         source_idx = 0
     merged_ledger["transactions"].extend(source_ledger["transactions"][source_idx:])
     return merged_ledger
 
+def merge_ledger_tail(source_ledger, target_tail, require_overlap):
+    # Like merge_ledgers, but given only the metadata and the last
+    # transactions of the target ledger. Returns the source
+    # transactions that should be appended to the target, or None if
+    # the tail is not enough to decide (in which case the full target
+    # must be consulted).
+    source_transactions = source_ledger["transactions"]
+    tail_transactions = target_tail["transactions"]
+    check_metadata_matches(source_ledger["metadata"], target_tail["metadata"])
+    if not source_transactions:
+        return []
+    tail_idx = find_alignment(source_transactions[0], tail_transactions)
+    if tail_idx is None:
+        return None
+    if require_overlap:
+        check_alignment(source_transactions, tail_transactions, tail_idx)
+    source_idx = len(tail_transactions) - tail_idx
+    return source_transactions[source_idx:]
+
+def merge_into_target_tail(source_ledger, target, require_overlap,
+                           codec=DEFAULT_CODEC):
+    # Try to merge using only the tail of the target ledger, given as
+    # a lazy LedgerReader. Returns the list of appended transactions
+    # and the new contents of the target (None if nothing was
+    # appended), or (None, None) if the full target ledger is needed.
+    # Appended transactions are written in the same format as the rest
+    # of the target.
+    tail = target.find_tail(len(source_ledger["transactions"]))
+    if tail is None or not tail["spans"]:
+        return None, None
+    target_tail = {
+        "metadata": target.metadata(),
+        "transactions": [target.decode_transaction(start, end)
+                         for start, end in tail["spans"]],
+    }
+    try:
+        appended = merge_ledger_tail(
+            source_ledger, target_tail, require_overlap)
+    except Failure as e:
+        raise type(e)("in file {}: {}".format(repr(target.path), str(e)))
+    if not appended:
+        return appended, None
+    element_codec = LedgerCodec(codec.backend, tail["layout"].format)
+    target_data = target.data
+    end = tail["end"]
+    ledger_str = (
+        target_data[:end].decode() +
+        "".join(",\n" + element_codec.dumps_transaction(
+            serialize_transaction(transaction))
+                for transaction in appended) +
+        target_data[end:].decode())
+    return appended, ledger_str
+
+# Rough peak memory use of an in-memory merge per byte of the source
+# and target ledger files, as measured with the stdlib backend.
+MERGE_MEMORY_FACTOR = 6
+
+# Largest number of bytes copied from one ledger file to another in
+# a single write during a streamed merge.
+STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+
+def memory_budget(io):
+    # The memory budget of the current command in bytes, or None if
+    # there is none.
+    config = getattr(io, "config", None) or {}
+    megabytes = config.get("memory-budget")
+    if megabytes is None:
+        return None
+    return megabytes * 1024 * 1024
+
+def open_streamed_ledger(data, path):
+    # Locate the parts of a ledger file (bytes or mmap) written by
+    # LedgerCodec that a streamed merge needs, without looking at the
+    # transactions. Returns a map with keys path, data, metadata, layout,
+    # start (the opening bracket of the transactions list) and end
+    # (where the closing pattern of the layout begins, or None for an
+    # empty list), or None if the file does not have a known layout.
+    metadata, array_start = scan_ledger_header(data)
+    if metadata is None or array_start is None:
+        return None
+    layout = detect_layout(data, array_start)
+    if layout is None:
+        return None
+    if data[array_start:array_start + 2] == b"[]":
+        array_end = None
+    else:
+        array_end = data.find(layout.array_end, array_start)
+        if array_end == -1:
+            return None
+    return {
+        "path": path,
+        "data": data,
+        "metadata": metadata,
+        "layout": layout,
+        "start": array_start,
+        "end": array_end,
+    }
+
+def iter_streamed_spans(ledger, position=None, reverse=False):
+    # Yield the spans of the transactions of a ledger returned by
+    # open_streamed_ledger one at a time (see iter_layout_spans).
+    if ledger["end"] is None:
+        return
+    try:
+        yield from iter_layout_spans(
+            ledger["data"], ledger["layout"], ledger["start"], ledger["end"],
+            position, reverse)
+    except UserDataError as e:
+        raise type(e)("in file {}: {}".format(repr(ledger["path"]), str(e)))
+
+def decode_streamed(ledger, span, codec):
+    # Decode a span of a streamed ledger, leaving dates as strings.
+    try:
+        return codec.loads(ledger["data"][span[0]:span[1]])
+    except ValueError as e:
+        raise UserDataError("in file {}: malformed JSON: {}"
+                            .format(repr(ledger["path"]), str(e)))
+
+def find_streamed_tail_alignment(base_transaction, target, count, codec):
+    # Look for the alignment among the last count transactions of the
+    # target, scanning backwards as LedgerReader.find_tail does, with
+    # the same preference as find_alignment (applied to the tail only,
+    # as in merge_ledger_tail). Returns the number of target transactions
+    # from the alignment onwards and the span of the aligned
+    # transaction, or None if it is not in the tail.
+    base_id = base_transaction.get("id")
+    id_match = equivalent_match = None
+    for tail_count, span in enumerate(itertools.islice(
+            iter_streamed_spans(target, reverse=True), count), 1):
+        target_transaction = decode_streamed(target, span, codec)
+        if transactions_equivalent(base_transaction, target_transaction):
+            # Going backwards, so the last match seen comes first.
+            equivalent_match = tail_count, span
+            if target_transaction.get("id") == base_id:
+                id_match = tail_count, span
+    return id_match or equivalent_match
+
+def find_streamed_alignment(base_transaction, target, require_overlap,
+                            codec):
+    # Find the alignment in one pass over the whole target: the first
+    # equivalent transaction with the same ID, or failing that the
+    # first equivalent transaction (see find_alignment). Returns the
+    # same as find_streamed_tail_alignment, or raises an error
+    # like merge_ledgers if there is none and overlap is required.
+    base_id = base_transaction.get("id")
+    target_spans = iter_streamed_spans(target)
+    target_count = 0
+    id_match = equivalent_match = None
+    most_similar = most_similar_score = None
+    for target_idx, span in enumerate(target_spans):
+        target_count += 1
+        target_transaction = decode_streamed(target, span, codec)
+        if transactions_equivalent(base_transaction, target_transaction):
+            if target_transaction.get("id") == base_id:
+                id_match = target_idx, span
+                break
+            if equivalent_match is None:
+                equivalent_match = target_idx, span
+        if require_overlap and equivalent_match is None:
+            score = transaction_similarity(base_transaction, target_transaction)
+            if most_similar is None or score > most_similar_score:
+                most_similar, most_similar_score = target_transaction, score
+    # Count the rest of the target, if the search stopped early.
+    for span in target_spans:
+        target_count += 1
+    if not target_count:
+        return None
+    match = id_match or equivalent_match
+    if match is None:
+        if not require_overlap:
+            return None
+        base_transaction = deserialize_transaction(base_transaction)
+        most_similar = deserialize_transaction(most_similar)
+        raise UserDataError(
+            ("first transaction in source ({}) and most similar "
+             "transaction in target ledger ({}) {}")
+            .format(repr(base_transaction["id"]),
+                    repr(most_similar["id"]),
+                    diff_maps(base_transaction, most_similar)))
+    target_idx, span = match
+    return target_count - target_idx, span
+
+def plan_streamed_merge(source, target, require_overlap, codec):
+    # Like merge_ledgers, but given two ledgers returned by
+    # open_streamed_ledger, and holding only a few transactions in
+    # memory at a time. Returns the index of the first source
+    # transaction to append to the target. Transactions are compared
+    # as they appear in the files, which is equivalent since dates
+    # round-trip through serialize_transaction.
+    check_metadata_matches(decode_streamed(source, source["metadata"], codec),
+                           decode_streamed(target, target["metadata"], codec))
+    source_spans = iter_streamed_spans(source)
+    base_span = next(source_spans, None)
+    if base_span is None:
+        return 0
+    base_transaction = decode_streamed(source, base_span, codec)
+    try:
+        deserialize_transaction(dict(base_transaction))
+    except Failure as e:
+        raise type(e)("in file {}: {}".format(repr(source["path"]), str(e)))
+    # Usually only the last few transactions of the target overlap
+    # with the source, so look there first. Counting the source only
+    # looks for the layout patterns.
+    source_count = 1 + sum(1 for span in iter_streamed_spans(
+        source, base_span[1]))
+    match = find_streamed_tail_alignment(
+        base_transaction, target, source_count, codec)
+    if match is None:
+        match = find_streamed_alignment(
+            base_transaction, target, require_overlap, codec)
+    if match is None:
+        return 0
+    source_idx, target_span = match
+    if require_overlap:
+        # Ensure alignment continues, see check_alignment.
+        target_spans = iter_streamed_spans(
+            target, target_span[0] - len(target["layout"].element_start) + 1)
+        for source_span, span in zip(
+                itertools.chain([base_span], source_spans), target_spans):
+            source_transaction = decode_streamed(source, source_span, codec)
+            target_transaction = decode_streamed(target, span, codec)
+            if source_transaction != target_transaction:
+                check_alignment(
+                    [deserialize_transaction(source_transaction)],
+                    [deserialize_transaction(target_transaction)], 0)
+    return source_idx
+
+def write_streamed_merge(source, target, source_idx, f, codec):
+    # Write the target ledger with the source transactions from the
+    # given index onwards appended to the binary file f. Everything
+    # from the target is copied as is. Appended transactions are
+    # copied as is if the source has the same layout as the target,
+    # and re-encoded otherwise. Returns the number of transactions
+    # appended.
+    data = target["data"]
+    layout = target["layout"]
+    if target["end"] is None:
+        # Replace "[]" with a list in the layout.
+        insert, resume = target["start"] + 1, target["start"] + 2
+        closing = layout.array_end
+    else:
+        insert = resume = target["end"]
+        closing = b""
+    for offset in range(0, insert, STREAM_CHUNK_SIZE):
+        f.write(data[offset:min(offset + STREAM_CHUNK_SIZE, insert)])
+    element_codec = LedgerCodec(codec.backend, layout.format)
+    same_layout = source["layout"] is layout
+    # The whitespace that precedes a transaction on its first line.
+    indent = layout.element_start[1:-1]
+    appended = 0
+    for span in itertools.islice(
+            iter_streamed_spans(source), source_idx, None):
+        transaction = decode_streamed(source, span, codec)
+        try:
+            deserialize_transaction(transaction)
+        except Failure as e:
+            raise type(e)("in file {}: {}".format(repr(source["path"]), str(e)))
+        if appended or target["end"] is not None:
+            f.write(b",")
+        f.write(b"\n")
+        if same_layout:
+            f.write(indent)
+            f.write(source["data"][span[0]:span[1]])
+        else:
+            f.write(element_codec.dumps_transaction(
+                serialize_transaction(transaction)).encode())
+        appended += 1
+    if appended:
+        f.write(closing)
+    else:
+        f.write(data[insert:resume])
+    for offset in range(resume, len(data), STREAM_CHUNK_SIZE):
+        f.write(data[offset:min(offset + STREAM_CHUNK_SIZE, len(data))])
+    return appended
+
+def count_merged_on_commit(writes, io, count):
+    # Only count merged transactions once they are actually written,
+    # so that a command that fails afterwards (for example, in the Git
+    # checks) does not report them.
+    writes.after_commit(
+        functools.partial(io.metrics.count, "transactions-merged", count))
+
+def merge_streamed(source_file, target_file, require_overlap, io, codec):
+    # Merge two ledger files without loading either of them, writing
+    # the result to a temporary file that then replaces the target.
+    # Returns False, without doing anything, if either ledger does not
+    # have a known layout.
+    with io.open(source_file, "rb") as source_f, \
+         io.open(target_file, "rb") as target_f:
+        source_data = map_file(source_f, io.stat(source_file).st_size)
+        target_data = map_file(target_f, io.stat(target_file).st_size)
+        io.metrics.count("bytes-mapped", len(source_data) + len(target_data))
+        try:
+            source = open_streamed_ledger(source_data, source_file)
+            target = open_streamed_ledger(target_data, target_file)
+            if source is None or target is None:
+                return False
+            with io.metrics.phase("merge"):
+                source_idx = plan_streamed_merge(
+                    source, target, require_overlap, codec)
+            remaining = itertools.islice(
+                iter_streamed_spans(source), source_idx, None)
+            if next(remaining, None) is None:
+                return True
+            with io.metrics.phase("write"), staged_writes(io) as writes:
+                with writes.open(target_file, "wb") as f:
+                    appended = write_streamed_merge(
+                        source, target, source_idx, f, codec)
+                count_merged_on_commit(writes, io, appended)
+        finally:
+            for data in (source_data, target_data):
+                if isinstance(data, mmap.mmap):
+                    data.close()
+    return True
+
 def subcommand_merge(args, io, **kwargs):
     source_file = None
     target_file = None
@@ -412,47 +2021,1112 @@ def subcommand_merge(args, io, **kwargs):
         raise usage_error("merge")
     if not io.isfile(source_file):
         raise FilesystemError("no such file: {}".format(source_file))
-    try:
-        with open(source_file) as f:
-            source_ledger = f.read()
-    except OSError as e:
-        raise FilesystemError("could not read file {}: {}"
-                              .format(repr(source_file, str(e))))
-    try:
-        source_ledger = deserialize_ledger(source_ledger)
-    except Failure as e:
-        raise type(e)("in file {}: {}".format(repr(source_file), str(e)))
-    if io.isfile(target_file):
+    budget = memory_budget(io)
+    if budget is not None and io.isfile(target_file):
+        size = io.stat(source_file).st_size + io.stat(target_file).st_size
+        if size * MERGE_MEMORY_FACTOR > budget:
+            # Too big to merge in memory, so stream both ledgers.
+            try:
+                if merge_streamed(source_file, target_file, require_overlap,
+                                  io, ledger_codec(io)):
+                    return
+            except OSError as e:
+                raise FilesystemError("could not merge {} into {}: {}"
+                                      .format(repr(source_file),
+                                              repr(target_file), str(e)))
+    with io.metrics.phase("read"):
         try:
-            with open(target_file) as f:
-                target_ledger = f.read()
+            with io.open(source_file) as f:
+                source_ledger = f.read()
         except OSError as e:
             raise FilesystemError("could not read file {}: {}"
-                                  .format(repr(target_file, str(e))))
+                                  .format(repr(source_file), str(e)))
+        codec = ledger_codec(io)
         try:
-            target_ledger = deserialize_ledger(target_ledger)
+            source_ledger = deserialize_ledger(source_ledger, codec)
         except Failure as e:
-            raise type(e)("in file {}: {}".format(repr(target_file), str(e)))
-    else:
-        target_ledger = None
-    merged_ledger = merge_ledgers(
-        source_ledger, target_ledger, require_overlap)
-    ledger_str = serialize_ledger(merged_ledger)
+            raise type(e)("in file {}: {}".format(repr(source_file), str(e)))
+    target_ledger = None
+    ledger_str = None
+    if io.isfile(target_file):
+        # Usually only the last few transactions of the target overlap
+        # with the source, so try to avoid reading the whole target.
+        with io.metrics.phase("merge"), \
+             LedgerReader(target_file, io, codec=codec, lazy=True) as target:
+            appended, ledger_str = merge_into_target_tail(
+                source_ledger, target, require_overlap, codec)
+        if appended == []:
+            return
+        if appended is not None:
+            merged_count = len(appended)
+        if appended is None:
+            with io.metrics.phase("read"):
+                try:
+                    with io.open(target_file) as f:
+                        target_ledger = f.read()
+                except OSError as e:
+                    raise FilesystemError("could not read file {}: {}"
+                                          .format(repr(target_file), str(e)))
+                try:
+                    target_ledger = deserialize_ledger(target_ledger, codec)
+                except Failure as e:
+                    raise type(e)("in file {}: {}"
+                                  .format(repr(target_file), str(e)))
+    if ledger_str is None:
+        with io.metrics.phase("merge"):
+            merged_ledger = merge_ledgers(
+                source_ledger, target_ledger, require_overlap)
+        merged_count = (
+            len(merged_ledger["transactions"]) -
+            (len(target_ledger["transactions"]) if target_ledger else 0))
+        with io.metrics.phase("serialize"):
+            ledger_str = serialize_ledger(merged_ledger, codec) + "\n"
     target_dir = io.dirname(io.abspath(target_file))
+    with io.metrics.phase("write"):
+        try:
+            io.makedirs(target_dir, exist_ok=True)
+        except OSError as e:
+            raise FilesystemError(
+                "could not create directory {}: {}"
+                .format(repr(target_dir), str(e)))
+        try:
+            with staged_writes(io) as writes:
+                with writes.open(target_file) as f:
+                    f.write(ledger_str)
+                count_merged_on_commit(writes, io, merged_count)
+        except OSError as e:
+            raise FilesystemError(
+                "could not write file {}: {}"
+                .format(repr(target_file), str(e)))
+
+### check-refs
+
+def summarize_references(data):
+    # Reduce a ledger file to what is needed to check references: its
+    # transaction IDs and a flat list of (transaction index,
+    # transaction ID, key, kind, referenced ID) tuples. Problems with
+    # the shape of the references are recorded with a referenced ID
+    # of None. Returns None if the file is not a ledger.
     try:
-        io.makedirs(target_dir, exist_ok=True)
+        ledger = json.loads(data.decode())
+    except ValueError:
+        return None
+    if not isinstance(ledger, dict):
+        return None
+    transactions = ledger.get("transactions")
+    if not isinstance(transactions, list):
+        return None
+    ids = []
+    references = []
+    for idx, transaction in enumerate(transactions):
+        if not isinstance(transaction, dict):
+            continue
+        transaction_id = transaction.get("id")
+        if isinstance(transaction_id, str):
+            ids.append(transaction_id)
+        refs = transaction.get("references")
+        if refs is None:
+            continue
+        if not isinstance(refs, dict):
+            references.append((idx, transaction_id, None, None, None))
+            continue
+        for key, ref in refs.items():
+            if not isinstance(ref, dict):
+                references.append((idx, transaction_id, key, None, None))
+                continue
+            for kind in ("primary", "foreign"):
+                ref_ids = ref.get(kind, [])
+                if (not isinstance(ref_ids, list) or
+                    not all(isinstance(i, str) for i in ref_ids)):
+                    references.append((idx, transaction_id, key, kind, None))
+                    continue
+                for ref_id in ref_ids:
+                    references.append((idx, transaction_id, key, kind, ref_id))
+    return {
+        "ids": ids,
+        "references": references,
+    }
+
+def check_references(ledger_files, foreign_files, io, cache):
+    # Return a list of messages describing broken references in the
+    # given ledger files. foreign_files maps reference keys to ledger
+    # files; foreign ledgers are only summarized when a reference to
+    # them is actually encountered.
+    id_sets = {}
+    def summary(path):
+        try:
+            return cache.get(path, summarize_references)
+        except OSError as e:
+            raise FilesystemError("could not read file {}: {}"
+                                  .format(repr(path), str(e)))
+    def id_set(path):
+        path = io.abspath(path)
+        if path not in id_sets:
+            result = summary(path)
+            id_sets[path] = set(result["ids"]) if result else None
+        return id_sets[path]
+    problems = []
+    for ledger_file in ledger_files:
+        result = summary(ledger_file)
+        if result is None:
+            problems.append("{}: not a ledger file".format(ledger_file))
+            continue
+        for idx, transaction_id, key, kind, ref_id in result["references"]:
+            where = "{}: transaction {} ({})".format(
+                ledger_file, idx, repr(transaction_id))
+            if key is None:
+                problems.append("{}: 'references' is not a map".format(where))
+                continue
+            if kind is None:
+                problems.append("{}: reference {} is not a map"
+                                .format(where, repr(key)))
+                continue
+            if ref_id is None:
+                problems.append("{}: {} references under {} are not a list of strings"
+                                .format(where, kind, repr(key)))
+                continue
+            if kind == "primary":
+                ids = id_set(ledger_file)
+            else:
+                foreign_file = foreign_files.get(key)
+                if foreign_file is None or not io.isfile(foreign_file):
+                    problems.append("{}: no ledger for reference key {}"
+                                    .format(where, repr(key)))
+                    continue
+                ids = id_set(foreign_file)
+                if ids is None:
+                    problems.append("{}: reference key {} names {}, "
+                                    "which is not a ledger file"
+                                    .format(where, repr(key), foreign_file))
+                    continue
+            if ref_id not in ids:
+                problems.append("{}: {} reference {} under {} not found"
+                                .format(where, kind, repr(ref_id), repr(key)))
+    return problems
+
+def subcommand_check_refs(args, io, **kwargs):
+    ledger_files = []
+    foreign_files = {}
+    args_done = False
+    while args:
+        if not args_done:
+            if args[0] == "--":
+                args_done = True
+                args = args[1:]
+                continue
+            if args[0] == "--ref":
+                if len(args) < 3:
+                    raise usage_error("check-refs")
+                foreign_files[args[1]] = args[2]
+                args = args[3:]
+                continue
+            if args[0].startswith("-"):
+                raise usage_error("check-refs")
+        ledger_files.append(args[0])
+        args = args[1:]
+    root = library_root(io)
+    library_files = find_library_files(io, root)
+    for path in library_files:
+        foreign_files.setdefault(ledger_name(path, root, io), path)
+    if not ledger_files:
+        ledger_files = [io.relpath(path) for path in library_files]
+    for ledger_file in ledger_files:
+        if not io.isfile(ledger_file):
+            raise FilesystemError("no such file: {}".format(ledger_file))
+    cache = FileCache("references", io)
+    with io.metrics.phase("check"):
+        problems = check_references(ledger_files, foreign_files, io, cache)
+    cache.save()
+    for problem in problems:
+        io.print(problem)
+    if problems:
+        raise UserDataError("found {} broken reference{}".format(
+            len(problems), "" if len(problems) == 1 else "s"))
+
+### check
+
+TRANSACTION_TYPES = ("debit", "credit", "transfer")
+
+CHECK_CHUNK_SIZE = 20000
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+def metadata_violations(metadata):
+    if metadata is None:
+        yield "missing key 'metadata'"
+        return
+    if not isinstance(metadata, dict):
+        yield "'metadata' is not a map"
+        return
+    if "accounts" not in metadata:
+        yield "missing key 'accounts' in 'metadata'"
+        return
+    accounts = metadata["accounts"]
+    if not is_string_list(accounts):
+        yield "'accounts' in 'metadata' is not a list of strings"
+        return
+    if len(accounts) != len(set(accounts)):
+        yield "'accounts' in 'metadata' has duplicates"
+
+def transaction_violations(transaction, accounts):
+    # Yield a message for every way in which the transaction (as
+    # decoded from JSON, without deserialize_transaction) does not
+    # follow the ledger format described in the README.
+    if not isinstance(transaction, dict):
+        yield "transaction is not a map"
+        return
+    for key in ("id", "amount", "type", "date"):
+        if key not in transaction:
+            yield "missing key {}".format(repr(key))
+    if "id" in transaction and not isinstance(transaction["id"], str):
+        yield "'id' is not a string"
+    if ("description" in transaction and
+        not isinstance(transaction["description"], str)):
+        yield "'description' is not a string"
+    if "amount" in transaction and not is_number(transaction["amount"]):
+        yield "'amount' is not a number"
+    transaction_type = transaction.get("type")
+    if "type" in transaction and transaction_type not in TRANSACTION_TYPES:
+        yield "'type' is not one of {}: {}".format(
+            ", ".join(TRANSACTION_TYPES), repr(transaction_type))
+    if transaction_type == "transfer":
+        required = ("source-account", "target-account")
+        forbidden = ("account",)
+    elif transaction_type in TRANSACTION_TYPES:
+        required = ("account",)
+        forbidden = ("source-account", "target-account")
+    else:
+        required = forbidden = ()
+    for key in required:
+        if key not in transaction:
+            yield "missing key {} for type {}".format(
+                repr(key), repr(transaction_type))
+        elif not isinstance(transaction[key], str):
+            yield "{} is not a string".format(repr(key))
+        elif accounts is not None and transaction[key] not in accounts:
+            yield "{} names an account not listed in metadata: {}".format(
+                repr(key), repr(transaction[key]))
+    for key in forbidden:
+        if key in transaction:
+            yield "unexpected key {} for type {}".format(
+                repr(key), repr(transaction_type))
+    if "date" in transaction:
+        date = transaction["date"]
+        if not isinstance(date, str):
+            yield "'date' is not a string"
+        else:
+            try:
+                deserialize_transaction({"date": date})
+            except (UserDataError, TypeError):
+                yield "malformed date: {}".format(repr(date))
+    if "tags" in transaction and not is_string_list(transaction["tags"]):
+        yield "'tags' is not a list of strings"
+    if "references" in transaction:
+        references = transaction["references"]
+        if not isinstance(references, dict):
+            yield "'references' is not a map"
+        else:
+            for key, ref in references.items():
+                if not isinstance(ref, dict):
+                    yield "reference {} is not a map".format(repr(key))
+                    continue
+                for kind in ("primary", "foreign"):
+                    if kind in ref and not is_string_list(ref[kind]):
+                        yield "{} references under {} are not a list of strings".format(
+                            kind, repr(key))
+
+def check_transaction_chunk(path, starts, ends, following, last, first_idx,
+                            accounts, backend_name):
+    # Validate the transactions at the given byte spans of a ledger
+    # file, returning a list of (byte offset, transaction index,
+    # transaction ID, message) tuples. following is the offset of the
+    # transaction after the chunk, or of the closing bracket of the
+    # transactions list if the chunk is the last one; the bytes between
+    # transactions are checked too, so that elements of the list that
+    # are not maps (which the index skips) are reported. This runs in
+    # worker processes, so it opens the file itself.
+    backend = load_json_backend(backend_name)
+    if accounts is not None:
+        accounts = set(accounts)
+    problems = []
+    with open(path, "rb") as f:
+        data = map_file(f, os.fstat(f.fileno()).st_size)
+        for offset, (start, end) in enumerate(zip(starts, ends)):
+            idx = first_idx + offset
+            try:
+                transaction = backend.loads(data[start:end])
+            except ValueError as e:
+                problems.append((start, idx, None,
+                                 "malformed JSON: {}".format(str(e))))
+                transaction = None
+            if transaction is not None:
+                transaction_id = None
+                if isinstance(transaction, dict):
+                    transaction_id = transaction.get("id")
+                for message in transaction_violations(transaction, accounts):
+                    problems.append((start, idx, transaction_id, message))
+            if offset + 1 < len(starts):
+                next_start = starts[offset + 1]
+                separator = b","
+            else:
+                next_start = following
+                separator = b"" if last else b","
+            if data[end:next_start].strip() != separator:
+                problems.append((end, idx, None,
+                                 "unexpected content after transaction"))
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return problems
+
+def line_numbers(data, offsets):
+    # Map byte offsets to line numbers with a single pass over the
+    # data.
+    result = {}
+    line, position = 1, 0
+    for offset in sorted(set(offsets)):
+        line += data[position:offset].count(b"\n")
+        position = offset
+        result[offset] = line
+    return result
+
+def check_ledger(path, io, jobs, executor, cache):
+    # Return a list of messages describing schema violations in the
+    # ledger file. Chunks of transactions are validated in the
+    # executor, if there is more than one chunk.
+    problems = []
+    backend_name = ledger_codec(io).backend.name
+    with LedgerReader(path, io, cache) as reader:
+        data = reader.data
+        index = reader.index
+        try:
+            metadata = reader.metadata()
+        except UserDataError as e:
+            metadata = None
+            problems.append((index["metadata"][0], None, None, str(e)))
+        else:
+            for message in metadata_violations(metadata):
+                offset = index["metadata"][0] if index["metadata"] else 0
+                problems.append((offset, None, None, message))
+        accounts = None
+        if isinstance(metadata, dict) and is_string_list(metadata.get("accounts")):
+            accounts = metadata["accounts"]
+        starts, ends = index["starts"], index["ends"]
+        array_start, array_end = index["transactions"]
+        first = starts[0] if starts else array_end - 1
+        if data[array_start + 1:first].strip():
+            problems.append((array_start, None, None,
+                             "unexpected content before first transaction"))
+        chunks = []
+        for chunk_start in range(0, len(starts), CHECK_CHUNK_SIZE):
+            chunk_end = min(chunk_start + CHECK_CHUNK_SIZE, len(starts))
+            last = chunk_end == len(starts)
+            following = array_end - 1 if last else starts[chunk_end]
+            chunks.append((io.abspath(path),
+                           starts[chunk_start:chunk_end],
+                           ends[chunk_start:chunk_end],
+                           following, last, chunk_start, accounts,
+                           backend_name))
+        if len(chunks) > 1 and jobs > 1:
+            if executor[0] is None:
+                executor[0] = concurrent.futures.ProcessPoolExecutor(jobs)
+                io.metrics.count("subprocesses", jobs)
+            futures = [executor[0].submit(check_transaction_chunk, *chunk)
+                       for chunk in chunks]
+            for future in futures:
+                problems.extend(future.result())
+        else:
+            for chunk in chunks:
+                problems.extend(check_transaction_chunk(*chunk))
+        seen = {}
+        for idx, transaction_id in enumerate(index["ids"]):
+            if not isinstance(transaction_id, str):
+                continue
+            if transaction_id in seen:
+                problems.append((starts[idx], idx, transaction_id,
+                                 "duplicate ID (first used by transaction {})"
+                                 .format(seen[transaction_id])))
+            else:
+                seen[transaction_id] = idx
+        problems.sort(key=lambda problem: problem[0])
+        lines = line_numbers(data, [problem[0] for problem in problems])
+    messages = []
+    for offset, idx, transaction_id, message in problems:
+        where = "{}:{}".format(path, lines[offset])
+        if idx is not None:
+            where += ": transaction {}".format(idx)
+            if transaction_id is not None:
+                where += " ({})".format(repr(transaction_id))
+        messages.append("{}: {}".format(where, message))
+    return messages
+
+def subcommand_check(args, io, **kwargs):
+    ledger_files, jobs = parse_ledger_jobs_args(args, "check", io)
+    if not ledger_files:
+        ledger_files = [io.relpath(path) for path in find_library_files(io)]
+    for ledger_file in ledger_files:
+        if not io.isfile(ledger_file):
+            raise FilesystemError("no such file: {}".format(ledger_file))
+    cache = FileCache(LEDGER_INDEX_CACHE, io)
+    # The process pool is only started once some ledger turns out to
+    # be big enough to need it.
+    executor = [None]
+    problems = []
+    try:
+        with io.metrics.phase("check"):
+            for ledger_file in ledger_files:
+                try:
+                    problems.extend(check_ledger(
+                        ledger_file, io, jobs, executor, cache))
+                except UserDataError as e:
+                    problems.append(str(e))
+    finally:
+        if executor[0] is not None:
+            executor[0].shutdown()
+    cache.save()
+    for problem in problems:
+        io.print(problem)
+    if problems:
+        raise UserDataError("found {} schema violation{}".format(
+            len(problems), "" if len(problems) == 1 else "s"))
+
+### diff
+
+FINGERPRINT_ENCODER = json.JSONEncoder(
+    sort_keys=True, separators=(",", ":"), default=str)
+
+def transaction_fingerprint(transaction):
+    # Canonical JSON of everything but the ID, so that two
+    # transactions have the same fingerprint exactly when
+    # transactions_equivalent holds.
+    if isinstance(transaction, dict) and "id" in transaction:
+        transaction = dict(transaction)
+        del transaction["id"]
+    return FINGERPRINT_ENCODER.encode(transaction)
+
+def longest_common_subsequence(a, b):
+    # Return the pairs of indices of a longest common subsequence of
+    # the two lists, in increasing order, using the Hunt-Szymanski
+    # algorithm: its running time grows with the number of pairs of
+    # equal elements rather than with the product of the lengths.
+    positions = {}
+    for idx, value in enumerate(a):
+        positions.setdefault(value, []).append(idx)
+    # thresholds[k] is the smallest index into a at which a common
+    # subsequence of length k + 1 can end so far, and links[k] is the
+    # last pair of that subsequence, linked to the pair before it.
+    thresholds = []
+    links = []
+    for b_idx, value in enumerate(b):
+        # Going down, so that no two pairs use the same b_idx.
+        for a_idx in reversed(positions.get(value, ())):
+            k = bisect.bisect_left(thresholds, a_idx)
+            if k < len(thresholds) and thresholds[k] == a_idx:
+                continue
+            link = (a_idx, b_idx, links[k - 1] if k else None)
+            if k == len(thresholds):
+                thresholds.append(a_idx)
+                links.append(link)
+            else:
+                thresholds[k] = a_idx
+                links[k] = link
+    pairs = []
+    link = links[-1] if links else None
+    while link is not None:
+        a_idx, b_idx, link = link
+        pairs.append((a_idx, b_idx))
+    pairs.reverse()
+    return pairs
+
+def align_fingerprints(old, new):
+    # Return the pairs of indices of a longest common subsequence of
+    # the two fingerprint lists, in increasing order.
+    prefix = 0
+    while (prefix < min(len(old), len(new)) and
+           old[prefix] == new[prefix]):
+        prefix += 1
+    suffix = 0
+    while (suffix < min(len(old), len(new)) - prefix and
+           old[-1 - suffix] == new[-1 - suffix]):
+        suffix += 1
+    pairs = [(idx, idx) for idx in range(prefix)]
+    # Fingerprints that occur on only one side can never be part of
+    # the subsequence, so leave them out of the quadratic part.
+    old_middle = range(prefix, len(old) - suffix)
+    new_middle = range(prefix, len(new) - suffix)
+    common = ({old[idx] for idx in old_middle} &
+              {new[idx] for idx in new_middle})
+    old_kept = [idx for idx in old_middle if old[idx] in common]
+    new_kept = [idx for idx in new_middle if new[idx] in common]
+    for old_idx, new_idx in longest_common_subsequence(
+            [old[idx] for idx in old_kept], [new[idx] for idx in new_kept]):
+        pairs.append((old_kept[old_idx], new_kept[new_idx]))
+    pairs.extend((len(old) - suffix + offset, len(new) - suffix + offset)
+                 for offset in range(suffix))
+    return pairs
+
+def transactions_similar(t1, t2):
+    # Whether two non-equivalent transactions are close enough to be
+    # reported as one modified transaction.
+    if not isinstance(t1, dict) or not isinstance(t2, dict):
+        return False
+    keys = (set(t1) | set(t2)) - {"id"}
+    return len(diff_all_maps(t1, t2, ["id"])) * 2 <= len(keys)
+
+def diff_transactions(old, new):
+    # Return lists of matched and modified pairs of indices into the
+    # old and new transaction lists, and of the indices of the removed
+    # and added transactions. Transactions are matched by fingerprint;
+    # the remaining ones are paired up as modified if they have the
+    # same ID, or failing that if they are similar and fall between
+    # the same matched transactions.
+    old_fingerprints = [transaction_fingerprint(t) for t in old]
+    new_fingerprints = [transaction_fingerprint(t) for t in new]
+    anchors = align_fingerprints(old_fingerprints, new_fingerprints)
+    matched = list(anchors)
+    old_paired = [False] * len(old)
+    new_paired = [False] * len(new)
+    for old_idx, new_idx in anchors:
+        old_paired[old_idx] = new_paired[new_idx] = True
+    # Equivalent transactions that were moved are matched too.
+    moved = {}
+    for new_idx in reversed(range(len(new))):
+        if not new_paired[new_idx]:
+            moved.setdefault(new_fingerprints[new_idx], []).append(new_idx)
+    for old_idx in range(len(old)):
+        candidates = moved.get(old_fingerprints[old_idx])
+        if not old_paired[old_idx] and candidates:
+            new_idx = candidates.pop()
+            matched.append((old_idx, new_idx))
+            old_paired[old_idx] = new_paired[new_idx] = True
+    modified = []
+    new_ids = {}
+    for new_idx, transaction in enumerate(new):
+        if not new_paired[new_idx] and isinstance(transaction, dict):
+            transaction_id = transaction.get("id")
+            if isinstance(transaction_id, str):
+                new_ids.setdefault(transaction_id, new_idx)
+    for old_idx, transaction in enumerate(old):
+        if old_paired[old_idx] or not isinstance(transaction, dict):
+            continue
+        new_idx = new_ids.get(transaction.get("id"))
+        if new_idx is not None and not new_paired[new_idx]:
+            modified.append((old_idx, new_idx))
+            old_paired[old_idx] = new_paired[new_idx] = True
+    old_prev = new_prev = -1
+    for old_next, new_next in anchors + [(len(old), len(new))]:
+        old_gap = [idx for idx in range(old_prev + 1, old_next)
+                   if not old_paired[idx]]
+        new_gap = [idx for idx in range(new_prev + 1, new_next)
+                   if not new_paired[idx]]
+        for old_idx, new_idx in zip(old_gap, new_gap):
+            if transactions_similar(old[old_idx], new[new_idx]):
+                modified.append((old_idx, new_idx))
+                old_paired[old_idx] = new_paired[new_idx] = True
+        old_prev, new_prev = old_next, new_next
+    removed = [idx for idx in range(len(old)) if not old_paired[idx]]
+    added = [idx for idx in range(len(new)) if not new_paired[idx]]
+    return sorted(matched), sorted(modified), removed, added
+
+def read_ledger_for_diff(path, io, codec):
+    # Dates are left as strings, since they are only compared.
+    try:
+        with io.open(path, "rb") as f:
+            data = f.read()
     except OSError as e:
-        raise FilesystemError(
-            "could not create directory {}: {}"
-            .format(repr(target_dir), str(e)))
+        raise FilesystemError("could not read file {}: {}"
+                              .format(repr(path), str(e)))
     try:
-        with io.open(target_file, "w") as f:
-            f.write(ledger_str)
-            f.write("\n")
+        ledger = codec.loads(data)
+    except ValueError as e:
+        raise UserDataError("in file {}: malformed JSON: {}"
+                            .format(repr(path), str(e)))
+    if (not isinstance(ledger, dict) or
+        not isinstance(ledger.get("metadata"), dict) or
+        not isinstance(ledger.get("transactions"), list)):
+        raise UserDataError("in file {}: not a ledger".format(repr(path)))
+    return ledger
+
+def describe_transaction(transactions, idx):
+    transaction = transactions[idx]
+    if isinstance(transaction, dict) and "id" in transaction:
+        return "transaction {} ({})".format(idx, repr(transaction["id"]))
+    return "transaction {}".format(idx)
+
+def subcommand_diff(args, io, **kwargs):
+    ledger_files = []
+    args_done = False
+    for arg in args:
+        if not args_done:
+            if arg == "--":
+                args_done = True
+                continue
+            if arg.startswith("-"):
+                raise usage_error("diff")
+        ledger_files.append(arg)
+    if len(ledger_files) != 2:
+        raise usage_error("diff")
+    for ledger_file in ledger_files:
+        if not io.isfile(ledger_file):
+            raise FilesystemError("no such file: {}".format(ledger_file))
+    codec = ledger_codec(io)
+    with io.metrics.phase("read"):
+        old_ledger, new_ledger = (
+            read_ledger_for_diff(ledger_file, io, codec)
+            for ledger_file in ledger_files)
+    old = old_ledger["transactions"]
+    new = new_ledger["transactions"]
+    with io.metrics.phase("diff"):
+        matched, modified, removed, added = diff_transactions(old, new)
+    for key, v1, v2 in diff_all_maps(
+            old_ledger["metadata"], new_ledger["metadata"]):
+        io.print("metadata: {}: {} -> {}".format(key, repr(v1), repr(v2)))
+    for old_idx, new_idx in modified:
+        io.print("~ {} -> {}".format(describe_transaction(old, old_idx),
+                                     describe_transaction(new, new_idx)))
+        for key, v1, v2 in diff_all_maps(old[old_idx], new[new_idx]):
+            io.print("    {}: {} -> {}".format(key, repr(v1), repr(v2)))
+    for idx in removed:
+        io.print("- " + describe_transaction(old, idx))
+    for idx in added:
+        io.print("+ " + describe_transaction(new, idx))
+    io.print("{} matched, {} modified, {} removed, {} added".format(
+        len(matched), len(modified), len(removed), len(added)))
+
+### rollup
+
+def summarize_totals(backend_name, data):
+    # Reduce a ledger file to totals per account and year and per tag
+    # and year, each a list of [credits, debits, transaction count].
+    # Transfers count as a debit of the source account and a credit of
+    # the target account, but only towards the transaction count of
+    # their tags. Transactions that are too malformed to be counted
+    # are skipped (see acc check). Returns None if the file is not a
+    # ledger. This runs in worker processes.
+    try:
+        ledger = load_json_backend(backend_name).loads(data)
+    except ValueError:
+        return None
+    if (not isinstance(ledger, dict) or
+        not isinstance(ledger.get("transactions"), list)):
+        return None
+    accounts = {}
+    tags = {}
+    for transaction in ledger["transactions"]:
+        if not isinstance(transaction, dict):
+            continue
+        amount = transaction.get("amount")
+        date = transaction.get("date")
+        if not is_number(amount) or not isinstance(date, str):
+            continue
+        year = date[:4]
+        transaction_type = transaction.get("type")
+        if transaction_type == "credit":
+            effects = [(transaction.get("account"), amount)]
+        elif transaction_type == "debit":
+            effects = [(transaction.get("account"), -amount)]
+        elif transaction_type == "transfer":
+            effects = [(transaction.get("source-account"), -amount),
+                       (transaction.get("target-account"), amount)]
+        else:
+            continue
+        for account, delta in effects:
+            if not isinstance(account, str):
+                continue
+            row = accounts.setdefault(account, {}).setdefault(year, [0, 0, 0])
+            row[0 if delta >= 0 else 1] += abs(delta)
+            row[2] += 1
+        transaction_tags = transaction.get("tags", [])
+        if not is_string_list(transaction_tags):
+            continue
+        for tag in set(transaction_tags):
+            row = tags.setdefault(tag, {}).setdefault(year, [0, 0, 0])
+            if transaction_type == "credit":
+                row[0] += amount
+            elif transaction_type == "debit":
+                row[1] += amount
+            row[2] += 1
+    return {
+        "accounts": accounts,
+        "tags": tags,
+    }
+
+def add_totals(totals, summary):
+    for group in ("accounts", "tags"):
+        for name, years in summary[group].items():
+            for year, row in years.items():
+                total = totals[group].setdefault(name, {}).setdefault(
+                    year, [0, 0, 0])
+                for idx, value in enumerate(row):
+                    total[idx] += value
+
+def format_totals(heading, totals):
+    rows = [(heading, "year", "credits", "debits", "net", "transactions")]
+    for name in sorted(totals):
+        for year in sorted(totals[name]):
+            credits, debits, count = totals[name][year]
+            rows.append((name, year, "{:.2f}".format(credits),
+                         "{:.2f}".format(debits),
+                         "{:.2f}".format(credits - debits), str(count)))
+    widths = [max(len(row[idx]) for row in rows) for idx in range(6)]
+    return ["  ".join(
+        [row[0].ljust(widths[0]), row[1].ljust(widths[1])] +
+        [value.rjust(width) for value, width in zip(row[2:], widths[2:])])
+            for row in rows]
+
+def subcommand_rollup(args, io, **kwargs):
+    ledger_files, jobs = parse_ledger_jobs_args(args, "rollup", io)
+    if not ledger_files:
+        ledger_files = [io.relpath(path) for path in find_library_files(io)]
+    for ledger_file in ledger_files:
+        if not io.isfile(ledger_file):
+            raise FilesystemError("no such file: {}".format(ledger_file))
+    cache = FileCache("totals", io)
+    compute = functools.partial(
+        summarize_totals, ledger_codec(io).backend.name)
+    try:
+        with io.metrics.phase("summarize"):
+            summaries = cache.get_many(ledger_files, compute, jobs)
     except OSError as e:
+        raise FilesystemError("could not read ledgers: {}".format(str(e)))
+    cache.save()
+    totals = {"accounts": {}, "tags": {}}
+    for ledger_file, summary in zip(ledger_files, summaries):
+        if summary is None:
+            io.print_stderr("skipping {}: not a ledger file".format(ledger_file))
+            continue
+        add_totals(totals, summary)
+    lines = format_totals("account", totals["accounts"])
+    if totals["tags"]:
+        lines += [""] + format_totals("tag", totals["tags"])
+    for line in lines:
+        io.print(line)
+
+### export
+
+EXPORT_FORMAT = "acc-columnar"
+EXPORT_VERSION = 1
+EXPORT_MANIFEST = "manifest.json"
+
+# Transactions per segment, so that an export of a big library does
+# not have to be built in memory all at once.
+EXPORT_SEGMENT_ROWS = 1000000
+
+# Dictionaries that string columns are encoded with. Codes are
+# positions in the dictionary, or -1 for a missing value.
+EXPORT_DICTIONARIES = ("ledger", "type", "account", "description", "tag")
+
+# Columns with one element per transaction, except tag-offsets (one
+# more than that, delimiting each transaction's codes in tags), and
+# tags. Dictionary-encoded columns are int32 and name their
+# dictionary.
+EXPORT_COLUMNS = {
+    "ledger": ("int32", "ledger"),
+    "index": ("int64", None),
+    "id": ("str", None),
+    "date": ("datetime64[s]", None),
+    "amount": ("float64", None),
+    "type": ("int32", "type"),
+    "account": ("int32", "account"),
+    "source-account": ("int32", "account"),
+    "target-account": ("int32", "account"),
+    "description": ("int32", "description"),
+    "tag-offsets": ("int64", None),
+    "tags": ("int32", "tag"),
+}
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ExternalCommandError("NumPy is not installed")
+    return numpy
+
+def export_date(date):
+    # Datetimes with a time zone are exported in UTC.
+    if isinstance(date, datetime.datetime) and date.tzinfo is not None:
+        return date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if isinstance(date, datetime.date):
+        return date
+    return None
+
+class ExportBuilder:
+    # Accumulates transactions as columns for one segment at a time.
+    # Dictionaries are append-only across segments, and each segment
+    # stores the strings that were added to the dictionaries while it
+    # was built.
+
+    def __init__(self, dictionaries):
+        self.codes = {
+            name: {string: code for code, string in enumerate(strings)}
+            for name, strings in dictionaries.items()}
+        self.reset()
+
+    def reset(self):
+        self.columns = {name: [] for name in EXPORT_COLUMNS}
+        self.columns["tag-offsets"].append(0)
+        self.added = {name: [] for name in EXPORT_DICTIONARIES}
+
+    def __len__(self):
+        return len(self.columns["index"])
+
+    def encode(self, dictionary, string):
+        if not isinstance(string, str):
+            return -1
+        codes = self.codes[dictionary]
+        code = codes.get(string)
+        if code is None:
+            code = codes[string] = len(codes)
+            self.added[dictionary].append(string)
+        return code
+
+    def add(self, ledger, idx, transaction):
+        columns = self.columns
+        columns["ledger"].append(self.encode("ledger", ledger))
+        columns["index"].append(idx)
+        transaction_id = transaction.get("id")
+        columns["id"].append(
+            transaction_id if isinstance(transaction_id, str) else "")
+        columns["date"].append(export_date(transaction.get("date")))
+        amount = transaction.get("amount")
+        columns["amount"].append(amount if is_number(amount) else float("nan"))
+        columns["type"].append(self.encode("type", transaction.get("type")))
+        for key in ("account", "source-account", "target-account"):
+            columns[key].append(self.encode("account", transaction.get(key)))
+        columns["description"].append(
+            self.encode("description", transaction.get("description")))
+        tags = transaction.get("tags")
+        if is_string_list(tags):
+            columns["tags"].extend(self.encode("tag", tag) for tag in tags)
+        columns["tag-offsets"].append(len(columns["tags"]))
+
+    def arrays(self, numpy):
+        # Return the columns and the added dictionary strings of the
+        # segment as arrays.
+        arrays = {}
+        for name, (dtype, dictionary) in EXPORT_COLUMNS.items():
+            values = self.columns[name]
+            if dtype == "str":
+                arrays[name] = numpy.array(values, dtype=str)
+            else:
+                arrays[name] = numpy.array(values, dtype=dtype)
+        for name, strings in self.added.items():
+            arrays["dictionary-" + name] = numpy.array(strings, dtype=str)
+        return arrays
+
+def load_export_manifest(directory, io):
+    # Return the manifest of an export directory, or None if there is
+    # no (usable) export in it.
+    path = io.join(directory, EXPORT_MANIFEST)
+    if not io.isfile(path):
+        return None
+    try:
+        with io.open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(manifest, dict) or
+        manifest.get("format") != EXPORT_FORMAT or
+        manifest.get("version") != EXPORT_VERSION):
+        return None
+    return manifest
+
+def load_export(directory):
+    # Load an export written by acc export: returns a map with keys
+    # dictionaries (mapping each dictionary name to an array of its
+    # strings) and segments (a list of maps from column names to
+    # memory-mapped arrays). Only the dictionaries are copied into
+    # memory.
+    numpy = load_numpy()
+    with open(os.path.join(directory, EXPORT_MANIFEST)) as f:
+        manifest = json.load(f)
+    segments = []
+    chunks = {name: [] for name in EXPORT_DICTIONARIES}
+    for segment in manifest["segments"]:
+        path = os.path.join(directory, segment["name"])
+        columns = {}
+        for name in EXPORT_COLUMNS:
+            columns[name] = numpy.load(
+                os.path.join(path, name + ".npy"), mmap_mode="r")
+        for name in EXPORT_DICTIONARIES:
+            chunks[name].append(numpy.load(
+                os.path.join(path, "dictionary-" + name + ".npy")))
+        segments.append(columns)
+    dictionaries = {
+        name: (numpy.concatenate(arrays) if arrays
+               else numpy.array([], dtype=str))
+        for name, arrays in chunks.items()}
+    return {
+        "dictionaries": dictionaries,
+        "segments": segments,
+    }
+
+def export_prefix_digest(reader, count):
+    # Hash the transactions list of a ledger up to the end of its
+    # first count transactions, so that appending transactions (or
+    # changing the metadata) does not change the digest.
+    start = reader.index["transactions"][0]
+    end = reader.index["ends"][count - 1] if count else start
+    return sha256_hex(reader.data[start:end])
+
+def write_export_segment(directory, name, arrays, numpy, io):
+    # Write the arrays of a segment into a directory which only gets
+    # its final name once complete.
+    temp_path = io.join(directory, name + ".tmp")
+    path = io.join(directory, name)
+    # Leftovers of an export that was interrupted before it committed.
+    for leftover in (temp_path, path):
+        if io.exists(leftover):
+            io.rmtree(leftover)
+    io.makedirs(temp_path)
+    for column, array in arrays.items():
+        with io.open(io.join(temp_path, column + ".npy"), "wb") as f:
+            numpy.save(f, array, allow_pickle=False)
+    io.replace(temp_path, path)
+
+def ensure_export_ignored(directory, root, io):
+    # An export inside a Git-versioned library would leave untracked
+    # files behind, which stop acc import and acc merge from running,
+    # so it has to be ignored by Git.
+    directory = io.abspath(directory)
+    if not directory.startswith(io.join(io.abspath(root), "")):
+        return
+    if not locate_dominating_file(".git", io, root) or not io.which("git"):
+        return
+    try:
+        result = io.run(["git", "check-ignore", "-q", io.join(directory, "")])
+    except OSError as e:
+        raise ExternalCommandError(
+            "unexpected failure while running 'git': {}"
+            .format(str(e)))
+    if result.returncode > 1:
+        raise ExternalCommandError(
+            "command failed: {}".format(quote_command(result.args)))
+    if result.returncode != 0:
         raise FilesystemError(
-            "could not write file {}: {}"
-            .format(repr(target_file), str(e)))
+            "export directory is inside the Git repository of the library "
+            "but not ignored by Git: {}".format(directory))
+
+def subcommand_export(args, io, **kwargs):
+    paths = []
+    args_done = False
+    for arg in args:
+        if not args_done:
+            if arg == "--":
+                args_done = True
+                continue
+            if arg.startswith("-"):
+                raise usage_error("export")
+        paths.append(arg)
+    if not paths:
+        raise usage_error("export")
+    directory, *ledger_files = paths
+    numpy = load_numpy()
+    root = library_root(io)
+    ensure_export_ignored(directory, root, io)
+    whole_library = not ledger_files
+    if whole_library:
+        ledger_files = [
+            io.relpath(path) for path in find_library_files(io, root)]
+    for ledger_file in ledger_files:
+        if not io.isfile(ledger_file):
+            raise FilesystemError("no such file: {}".format(ledger_file))
+    manifest = load_export_manifest(directory, io)
+    if manifest is None and io.exists(directory) and (
+            not io.isdir(directory) or io.listdir(directory)):
+        raise FilesystemError("not an export directory: {}".format(directory))
+    old_segments = []
+    if manifest is not None:
+        old_segments = [segment["name"] for segment in manifest["segments"]]
+    cache = FileCache(LEDGER_INDEX_CACHE, io)
+    readers = []
+    try:
+        # Transactions that were exported before are skipped if their
+        # ledger has only been appended to since. Any other change
+        # means starting over.
+        rebuild = manifest is None
+        for ledger_file in ledger_files:
+            try:
+                reader = LedgerReader(ledger_file, io, cache)
+            except UserDataError as e:
+                if not whole_library:
+                    raise
+                io.print_stderr("skipping {}: {}".format(ledger_file, str(e)))
+                continue
+            readers.append((ledger_name(ledger_file, root, io), reader))
+        if manifest is not None:
+            names = {name for name, reader in readers}
+            if not set(manifest["ledgers"]) <= names:
+                rebuild = True
+            for name, reader in readers:
+                exported = manifest["ledgers"].get(name)
+                if exported and (
+                        exported["transactions"] > len(reader) or
+                        exported["sha256"] != export_prefix_digest(
+                            reader, exported["transactions"])):
+                    rebuild = True
+        if rebuild:
+            manifest = {
+                "format": EXPORT_FORMAT,
+                "version": EXPORT_VERSION,
+                "next-segment": (manifest or {}).get("next-segment", 0),
+                "segments": [],
+                "ledgers": {},
+            }
+            dictionaries = {name: [] for name in EXPORT_DICTIONARIES}
+        else:
+            dictionaries = load_export(directory)["dictionaries"]
+            dictionaries = {name: strings.tolist()
+                            for name, strings in dictionaries.items()}
+        builder = ExportBuilder(dictionaries)
+        new_segments = []
+        def flush():
+            name = "{:06d}".format(manifest["next-segment"])
+            manifest["next-segment"] += 1
+            write_export_segment(directory, name, builder.arrays(numpy),
+                                 numpy, io)
+            manifest["segments"].append({"name": name, "rows": len(builder)})
+            new_segments.append(name)
+            builder.reset()
+        io.makedirs(directory, exist_ok=True)
+        exported_count = 0
+        with io.metrics.phase("export"):
+            for name, reader in readers:
+                start = manifest["ledgers"].get(name, {}).get("transactions", 0)
+                for idx in range(start, len(reader)):
+                    builder.add(name, idx, reader.transaction(idx))
+                    if len(builder) == EXPORT_SEGMENT_ROWS:
+                        flush()
+                exported_count += len(reader) - start
+                manifest["ledgers"][name] = {
+                    "transactions": len(reader),
+                    "sha256": export_prefix_digest(reader, len(reader)),
+                }
+            if len(builder):
+                flush()
+        # Writing the manifest commits the export; segments that are
+        # no longer listed in it are removed afterwards.
+        with staged_writes(io) as writes:
+            with writes.open(io.join(directory, EXPORT_MANIFEST)) as f:
+                json.dump(manifest, f, indent=2)
+                f.write("\n")
+            if rebuild:
+                for name in old_segments:
+                    writes.after_commit(functools.partial(
+                        io.rmtree, io.join(directory, name)))
+    except OSError as e:
+        raise FilesystemError("could not export to {}: {}"
+                              .format(repr(directory), str(e)))
+    finally:
+        for name, reader in readers:
+            reader.close()
+    cache.save()
+    io.print("Exported {} transaction{} from {} ledger{} to {}".format(
+        exported_count, "" if exported_count == 1 else "s",
+        len(readers), "" if len(readers) == 1 else "s", directory))
 
 ## Configuration
 
@@ -496,6 +3170,27 @@ def load_config_file(filename, io):
                                     .format(val))
     else:
         config["aliases"] = {}
+    if "json-backend" in config:
+        backend = config["json-backend"]
+        if backend != "auto" and backend not in JSON_BACKENDS:
+            raise UserDataError("value of 'json-backend' is not one of {}"
+                                .format(", ".join(("auto",) + tuple(JSON_BACKENDS))))
+    if "importers" in config:
+        if not isinstance(config["importers"], dict):
+            raise UserDataError("value of 'importers' is not map")
+    if "id-scheme" in config:
+        if config["id-scheme"] not in ID_SCHEMES:
+            raise UserDataError("value of 'id-scheme' is not one of {}"
+                                .format(", ".join(ID_SCHEMES)))
+    if "ledger-format" in config:
+        if config["ledger-format"] not in LEDGER_FORMATS:
+            raise UserDataError("value of 'ledger-format' is not one of {}"
+                                .format(", ".join(LEDGER_FORMATS)))
+    if "memory-budget" in config:
+        budget = config["memory-budget"]
+        if (not isinstance(budget, int) or isinstance(budget, bool) or
+            budget <= 0):
+            raise UserDataError("value of 'memory-budget' is not a positive integer")
     return config
 
 ## Command line
@@ -504,6 +3199,11 @@ SUBCOMMANDS = {
     "init": subcommand_init,
     "import": subcommand_import,
     "merge": subcommand_merge,
+    "check-refs": subcommand_check_refs,
+    "check": subcommand_check,
+    "diff": subcommand_diff,
+    "rollup": subcommand_rollup,
+    "export": subcommand_export,
 }
 
 HELP_COMMANDS = ("help", "-h", "-help", "--help", "-?")
@@ -539,11 +3239,21 @@ def command_line(exec_name, args, io):
                 using_git = False
                 args = args[1:]
                 continue
+            if args[0] == "--metrics":
+                if len(args) == 1:
+                    raise usage_error()
+                io.metrics_file = args[1]
+                if io.metrics_file != "-":
+                    # Not affected by a later -C.
+                    io.metrics_file = io.abspath(io.metrics_file)
+                args = args[2:]
+                continue
             raise usage_error()
         original_args = args
         try:
             config_file = locate_dominating_file("config.json", io)
             config = load_config_file(config_file, io)
+            io.config = config
             config_or_none = config if config_file is not None else None
             config_error = None
         except Failure as e:
@@ -559,6 +3269,7 @@ def command_line(exec_name, args, io):
         elif config_error:
             raise config_error
         else:
+            check_work_tree = False
             seen_aliases = set()
             try:
                 while subcommand in config["aliases"]:
@@ -578,6 +3289,9 @@ def command_line(exec_name, args, io):
                     seen_aliases.add(subcommand)
                     commands.append(args)
                     subcommand, *args = args
+                io.metrics.set("command", subcommand)
+                io.metrics.set("aliases", [command[0] for command in commands[:-1]])
+                io.metrics.set("args", args)
                 if subcommand in SUBCOMMANDS:
                     if using_git is None:
                         if subcommand in SUBCOMMANDS_REQUESTING_GIT:
@@ -588,35 +3302,51 @@ def command_line(exec_name, args, io):
                                     "command not found: git")
                             using_git = True
                         elif subcommand in SUBCOMMANDS_USING_GIT:
-                            if locate_dominating_file(".git", io):
-                                result = io.run(
-                                    ["git", "rev-parse", "--is-inside-work-tree"],
-                                    stdout=io.PIPE)
-                                if result.returncode != 0:
-                                    raise ExternalCommandError(
-                                        "command failed: {}"
-                                        .format(quote_command(result.args)))
-                                response = result.stdout.decode().strip()
-                                if response != "true":
-                                    raise ExternalCommandError(
-                                        "unexpected response from command '{}': {}"
-                                        .format(quote_command(result.args), response))
-                                using_git = True
-                            else:
-                                using_git = False
+                            # Whether this is really a work tree is
+                            # checked with the other Git checks below.
+                            using_git = bool(locate_dominating_file(".git", io))
+                            check_work_tree = using_git
                     if using_git and not io.which("git"):
                         raise ExternalCommandError("command not found: git")
                     try:
                         if using_git and subcommand in SUBCOMMANDS_USING_GIT:
-                            ensure_working_tree_clean(io)
-                        if (subcommand in SUBCOMMANDS_USING_GIT or
-                            subcommand in SUBCOMMANDS_REQUESTING_GIT):
-                            SUBCOMMANDS[subcommand](args, io, using_git=using_git)
-                        else:
-                            SUBCOMMANDS[subcommand](args, io)
+                            # The Git checks mostly wait on the disk, as
+                            # does reading the ledgers, so run them at the
+                            # same time. Writes wait for the checks (see
+                            # IOWrapper).
+                            io.start_preflight(
+                                git_preflight, io, check_work_tree)
+                        try:
+                            with io.metrics.phase("subcommand"):
+                                if (subcommand in SUBCOMMANDS_USING_GIT or
+                                    subcommand in SUBCOMMANDS_REQUESTING_GIT):
+                                    SUBCOMMANDS[subcommand](
+                                        args, io, using_git=using_git)
+                                else:
+                                    SUBCOMMANDS[subcommand](args, io)
+                        except Failure:
+                            io.writes.abort()
+                            # A failed check is reported in preference to
+                            # whatever went wrong afterwards.
+                            io.wait_for_preflight()
+                            raise
+                        except BaseException:
+                            io.writes.abort()
+                            raise
+                        io.wait_for_preflight()
+                        # All files written by the subcommand replace
+                        # their targets at this single point.
+                        with io.metrics.phase("commit"):
+                            try:
+                                io.writes.commit()
+                            except OSError as e:
+                                io.writes.abort()
+                                raise FilesystemError(
+                                    "could not write files: {}".format(str(e)))
                         if using_git and subcommand in SUBCOMMANDS_USING_GIT:
-                            commit_working_tree(
-                                io, quote_command(["acc"] + original_args))
+                            with io.metrics.phase("git-commit"):
+                                commit_working_tree(
+                                    io, quote_command(["acc"] + original_args))
                     except StandardUsageError as e:
                         raise StandardUsageError(subcommand + " " + str(e))
                 else:
@@ -630,10 +3360,13 @@ def command_line(exec_name, args, io):
                 raise
     except StandardUsageError as e:
         io.print_stderr("usage: " + io.exec_name + " " + str(e))
-        return 1
+        status = 1
     except Failure as e:
         io.print_error(str(e))
-        return 1
+        status = 1
     except Success:
-        pass
-    return 0
+        status = 0
+    else:
+        status = 0
+    io.emit_metrics(status)
+    return status
@@ -1,6 +1,5 @@
 import acc
 
-import csv
 import dateutil.parser
 
 ## Parsing
@@ -9,7 +8,7 @@ InvalidInputError = acc.UserDataError
 
 HEADER_ROWS = 4
 
-def parse_row(row, row_id, account):
+def parse_row(row, row_id, account, id_scheme="random"):
     elevations_id = row[0]
     date = row[1]
     elevations_description = row[2]
@@ -82,7 +81,8 @@ def parse_row(row, row_id, account):
         amount = credit_delta
 
     return {
-        "id": acc.random_transaction_id(),
+        "id": acc.transaction_id(
+            id_scheme, "elevations_csv", account, elevations_id),
         "description": description,
         "amount": amount,
         "type": transaction_type,
@@ -95,24 +95,18 @@ def parse_row(row, row_id, account):
         "elevations_check_number": elevations_check_number,
     }
 
-def read_csv(csv_file, account, io):
+def read_rows(data, account, offset=0, rows=0, id_scheme="random"):
     transactions = []
-    with io.open(csv_file, newline="") as f:
-        reader = csv.reader(f)
-        for i in range(HEADER_ROWS):
-            next(reader)
-        for idx, row in enumerate(reader, HEADER_ROWS + 1):
-            transactions.append(parse_row(row, idx, account))
-    return {
-        "metadata": {
-            "accounts": [account],
-        },
-        "transactions": transactions,
-    }
+    for row, end in acc.iter_csv_rows(data, offset):
+        rows += 1
+        if rows > HEADER_ROWS:
+            transactions.append(parse_row(row, rows, account, id_scheme))
+        offset = end
+    return transactions, offset, rows
 
 ## Command line
 
-USAGE = "--from <csv-file> --to <json-file> --account <account>"
+USAGE = "--from <csv-file> --to <json-file> --account <account> [--incremental]"
 
 def usage():
     return acc.StandardUsageError(USAGE)
@@ -121,6 +115,7 @@ def run(args, io):
     csv_path = None
     json_path = None
     account = None
+    incremental = False
     while args:
         if args[0] == "--from":
             if len(args) == 1:
@@ -137,26 +132,16 @@ def run(args, io):
                 raise usage()
             account = args[1]
             args = args[2:]
+        elif args[0] == "--incremental":
+            incremental = True
+            args = args[1:]
         else:
             raise usage()
     if csv_path is None or json_path is None or account is None:
         raise usage()
-    try:
-        ledger = read_csv(csv_path, account, io)
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not read file {}: {}".format(repr(csv_path), str(e)))
-    ledger_str = acc.serialize_ledger(ledger)
-    json_dir = io.dirname(io.abspath(json_path))
-    try:
-        io.makedirs(json_dir, exist_ok=True)
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not create directory {}: {}".format(repr(json_dir), str(e)))
-    try:
-        with io.open(json_path, "w") as f:
-            f.write(ledger_str)
-            f.write("\n")
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not write file {}: {}".format(repr(json_path), str(e)))
+    metadata = {
+        "accounts": [account],
+    }
+    def read(data, offset, rows, id_scheme, state):
+        return read_rows(data, account, offset, rows, id_scheme) + (None,)
+    acc.run_csv_import(csv_path, json_path, metadata, read, incremental, io)
@@ -1,6 +1,5 @@
 import acc
 
-import csv
 import dateutil.parser
 
 ## Parsing
@@ -37,7 +36,7 @@ def parse_money(money, row_num):
         raise InvalidInputError("malformed monetary value in row {}: {}"
                                 .format(row_num, repr(money)))
 
-def parse_row(row, row_num):
+def parse_row(row, row_num, id_scheme="random"):
     date = row[0]
     description = row[2]
     transaction_id = row[3]
@@ -95,7 +94,10 @@ def parse_row(row, row_num):
         account = ACCOUNTS[nonzero_indices[0]]
 
     trans = {
-        "id": acc.random_transaction_id(),
+        # The native transaction IDs are unique across all accounts
+        # in the export, so no account is needed to qualify them.
+        "id": acc.transaction_id(
+            id_scheme, "radon_csv", None, transaction_id),
         "description": description,
         "amount": amount,
         "type": transaction_type,
@@ -112,23 +114,23 @@ def parse_row(row, row_num):
 
     return trans
 
-def read_csv(csv_file, io):
+def read_rows(data, offset=0, rows=0, id_scheme="random"):
+    # The footer rows are never included in the checkpoint, since
+    # they move whenever the export grows.
+    lines = list(acc.iter_csv_rows(data, offset))
+    if FOOTER_ROWS:
+        lines = lines[:-FOOTER_ROWS]
     transactions = []
-    with io.open(csv_file, newline="") as f:
-        lines = list(csv.reader(f))
-    lines = lines[HEADER_ROWS:-FOOTER_ROWS]
-    for idx, row in enumerate(lines, HEADER_ROWS + 1):
-        transactions.append(parse_row(row, idx))
-    return {
-        "metadata": {
-            "accounts": ACCOUNTS,
-        },
-        "transactions": transactions,
-    }
+    for row, end in lines:
+        rows += 1
+        if rows > HEADER_ROWS:
+            transactions.append(parse_row(row, rows, id_scheme))
+        offset = end
+    return transactions, offset, rows
 
 ## Command line
 
-USAGE = "--from <csv-file> --to <json-file>"
+USAGE = "--from <csv-file> --to <json-file> [--incremental]"
 
 def usage():
     return acc.StandardUsageError(USAGE)
@@ -136,6 +138,7 @@ def usage():
 def run(args, io):
     csv_path = None
     json_path = None
+    incremental = False
     while args:
         if args[0] == "--from":
             if len(args) == 1:
@@ -147,26 +150,16 @@ def run(args, io):
                 raise usage()
             json_path = args[1]
             args = args[2:]
+        elif args[0] == "--incremental":
+            incremental = True
+            args = args[1:]
         else:
             raise usage()
     if csv_path is None or json_path is None:
         raise usage()
-    try:
-        ledger = read_csv(csv_path, io)
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not read file {}: {}".format(repr(csv_path), str(e)))
-    ledger_str = acc.serialize_ledger(ledger)
-    json_dir = io.dirname(io.abspath(json_path))
-    try:
-        io.makedirs(json_dir, exist_ok=True)
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not create directory {}: {}".format(repr(json_dir), str(e)))
-    try:
-        with io.open(json_path, "w") as f:
-            f.write(ledger_str)
-            f.write("\n")
-    except OSError as e:
-        raise acc.FilesystemError(
-            "could not write file {}: {}".format(repr(json_path), str(e)))
+    metadata = {
+        "accounts": list(ACCOUNTS),
+    }
+    def read(data, offset, rows, id_scheme, state):
+        return read_rows(data, offset, rows, id_scheme) + (None,)
+    acc.run_csv_import(csv_path, json_path, metadata, read, incremental, io)
@@ -0,0 +1,465 @@
+import acc
+
+import datetime
+import dateutil.parser
+import json
+
+## Specs
+
+InvalidInputError = acc.UserDataError
+
+class InvalidSpecError(acc.UserDataError):
+    pass
+
+# A spec is a map with the following keys (columns are zero-based):
+#
+# name: name that content-derived IDs are qualified with (required in
+#     spec files; specs in the config file default to their key).
+# header-rows, footer-rows: number of rows to skip at the start and
+#     end of the file (default 0).
+# id: column holding the bank's own transaction ID (optional; without
+#     it, content-derived IDs are computed from the whole row and the
+#     number of identical rows before it).
+# date: column holding the date (required).
+# date-format: strptime format of the date (optional; without it the
+#     date is parsed with dateutil).
+# description: column, or list of columns whose non-empty values are
+#     joined with ": ", giving the description (required).
+# amount: column holding a signed amount, positive for credits.
+# debit, credit: columns holding debits and credits, exactly one of
+#     which must be non-empty in each row.
+# accounts: list of [column, account] pairs, each column holding the
+#     signed change to the balance of that account. Each row must have
+#     one non-zero change, or two that cancel out (a transfer).
+# account: the account for the amount or debit/credit style (can be
+#     given or overridden with --account on the command line).
+# money: map with optional keys symbol (a currency symbol that must
+#     follow the optional minus sign), thousands (separator to drop)
+#     and decimal (decimal separator, default ".").
+# tags: list of columns whose non-empty values become tags.
+# fields: map from extra transaction keys to maps with keys column
+#     and type (string, money or flag; default string).
+#
+# Exactly one of amount, debit/credit and accounts must be given.
+
+FIELD_TYPES = ("string", "money", "flag")
+
+def check_column(spec, key, value=None):
+    if value is None:
+        value = spec[key]
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise InvalidSpecError("value of {} is not a column number: {}"
+                               .format(repr(key), repr(value)))
+    return value
+
+def check_string(spec, key, value=None):
+    if value is None:
+        value = spec[key]
+    if not isinstance(value, str):
+        raise InvalidSpecError("value of {} is not a string: {}"
+                               .format(repr(key), repr(value)))
+    return value
+
+def normalize_spec(spec, account=None):
+    # Validate a spec and fill in defaults, returning a new map.
+    if not isinstance(spec, dict):
+        raise InvalidSpecError("spec is not a map")
+    result = {}
+    result["name"] = None
+    if spec.get("name") is not None:
+        result["name"] = check_string(spec, "name")
+    for key in ("header-rows", "footer-rows"):
+        value = spec.get(key, 0)
+        check_column(spec, key, value)
+        result[key] = value
+    result["id"] = None
+    if spec.get("id") is not None:
+        result["id"] = check_column(spec, "id")
+    if "date" not in spec:
+        raise InvalidSpecError("missing key 'date'")
+    result["date"] = check_column(spec, "date")
+    result["date-format"] = None
+    if spec.get("date-format") is not None:
+        result["date-format"] = check_string(spec, "date-format")
+    if "description" not in spec:
+        raise InvalidSpecError("missing key 'description'")
+    description = spec["description"]
+    if not isinstance(description, list):
+        description = [description]
+    if not description:
+        raise InvalidSpecError("value of 'description' is empty")
+    result["description"] = [
+        check_column(spec, "description", column) for column in description]
+    styles = [style for style in ("amount", "debit", "accounts")
+              if style in spec]
+    if "credit" in spec and "debit" not in spec:
+        raise InvalidSpecError("key 'credit' given without 'debit'")
+    if len(styles) != 1:
+        raise InvalidSpecError(
+            "exactly one of 'amount', 'debit' and 'accounts' must be given")
+    style = styles[0]
+    result["style"] = style
+    if style == "amount":
+        result["amount"] = check_column(spec, "amount")
+    elif style == "debit":
+        if "credit" not in spec:
+            raise InvalidSpecError("key 'debit' given without 'credit'")
+        result["debit"] = check_column(spec, "debit")
+        result["credit"] = check_column(spec, "credit")
+    else:
+        accounts = spec["accounts"]
+        if not isinstance(accounts, list) or not accounts:
+            raise InvalidSpecError("value of 'accounts' is not a non-empty list")
+        result["accounts"] = []
+        for pair in accounts:
+            if not isinstance(pair, list) or len(pair) != 2:
+                raise InvalidSpecError(
+                    "entry in 'accounts' is not a [column, account] pair: {}"
+                    .format(repr(pair)))
+            result["accounts"].append(
+                (check_column(spec, "accounts", pair[0]),
+                 check_string(spec, "accounts", pair[1])))
+        names = [name for column, name in result["accounts"]]
+        if len(names) != len(set(names)):
+            raise InvalidSpecError("duplicate account in 'accounts'")
+    if account is None:
+        account = spec.get("account")
+    if style == "accounts":
+        if account is not None:
+            raise InvalidSpecError(
+                "an account cannot be given together with 'accounts'")
+    elif account is None:
+        raise InvalidSpecError(
+            "no account given (use 'account' or --account)")
+    else:
+        check_string(spec, "account", account)
+    result["account"] = account
+    money = spec.get("money", {})
+    if not isinstance(money, dict):
+        raise InvalidSpecError("value of 'money' is not a map")
+    result["money"] = {
+        "symbol": check_string(money, "symbol", money.get("symbol", "")),
+        "thousands": check_string(money, "thousands", money.get("thousands", "")),
+        "decimal": check_string(money, "decimal", money.get("decimal", ".")),
+    }
+    tags = spec.get("tags", [])
+    if not isinstance(tags, list):
+        raise InvalidSpecError("value of 'tags' is not a list")
+    result["tags"] = [check_column(spec, "tags", column) for column in tags]
+    fields = spec.get("fields", {})
+    if not isinstance(fields, dict):
+        raise InvalidSpecError("value of 'fields' is not a map")
+    result["fields"] = []
+    for key, field in fields.items():
+        if not isinstance(field, dict) or "column" not in field:
+            raise InvalidSpecError("field {} is not a map with key 'column'"
+                                   .format(repr(key)))
+        field_type = field.get("type", "string")
+        if field_type not in FIELD_TYPES:
+            raise InvalidSpecError("type of field {} is not one of {}"
+                                   .format(repr(key), ", ".join(FIELD_TYPES)))
+        result["fields"].append(
+            (key, check_column(field, "column"), field_type))
+    return result
+
+def spec_accounts(spec):
+    if spec["style"] == "accounts":
+        return [name for column, name in spec["accounts"]]
+    return [spec["account"]]
+
+## Compilation
+
+def compile_spec(spec, importer_name):
+    # Generate the source of a row parser specialized to the spec, so
+    # that parsing a row runs straight-line code with constant column
+    # indices, like a hand-written importer. Returns a function
+    # parse_row(row, row_num, id_scheme, occurrence) that returns a
+    # transaction, where occurrence counts the identical rows before
+    # this one (only used when the spec has no id column).
+    # Everything taken from the spec is embedded with repr().
+    lines = []
+    emit = lines.append
+    money = spec["money"]
+
+    emit("def parse_money(money, row_num):")
+    emit("    if not money:")
+    emit("        return 0.0")
+    emit("    original = money")
+    emit("    negative = money.startswith('-')")
+    emit("    if negative:")
+    emit("        money = money[1:]")
+    if money["symbol"]:
+        emit("    if not money.startswith({}):".format(repr(money["symbol"])))
+        emit("        raise InvalidInputError('malformed monetary value in row {}: {}'")
+        emit("                                .format(row_num, repr(original)))")
+        emit("    money = money[{}:]".format(len(money["symbol"])))
+    if money["thousands"]:
+        emit("    money = money.replace({}, '')".format(repr(money["thousands"])))
+    if money["decimal"] != ".":
+        emit("    money = money.replace({}, '.')".format(repr(money["decimal"])))
+    emit("    try:")
+    emit("        value = float(money)")
+    emit("    except ValueError:")
+    emit("        raise InvalidInputError('malformed monetary value in row {}: {}'")
+    emit("                                .format(row_num, repr(original)))")
+    emit("    return -value if negative else value")
+    emit("")
+
+    columns = [spec["date"]] + spec["description"] + spec["tags"]
+    columns += [column for key, column, field_type in spec["fields"]]
+    if spec["id"] is not None:
+        columns.append(spec["id"])
+    if spec["style"] == "amount":
+        columns.append(spec["amount"])
+    elif spec["style"] == "debit":
+        columns += [spec["debit"], spec["credit"]]
+    else:
+        columns += [column for column, name in spec["accounts"]]
+    min_columns = max(columns) + 1
+
+    emit("def parse_row(row, row_num, id_scheme, occurrence=0):")
+    emit("    if len(row) < {}:".format(min_columns))
+    emit("        raise InvalidInputError('expected at least {} columns in row {{}}, got {{}}'"
+         .format(min_columns))
+    emit("                                .format(row_num, len(row)))")
+
+    if spec["id"] is not None:
+        emit("    native_id = row[{}]".format(spec["id"]))
+        emit("    if not native_id:")
+        emit("        raise InvalidInputError('missing transaction ID in row {}'.format(row_num))")
+        identity = "native_id"
+    else:
+        identity = "[row, occurrence]"
+
+    emit("    date = row[{}]".format(spec["date"]))
+    emit("    try:")
+    if spec["date-format"] is None:
+        emit("        date = parse_date(date)")
+    else:
+        emit("        date = strptime(date, {})".format(repr(spec["date-format"])))
+    emit("    except (ValueError, OverflowError):")
+    emit("        raise InvalidInputError('malformed date in row {}: {}'.format(row_num, repr(date)))")
+
+    if len(spec["description"]) == 1:
+        emit("    description = row[{}]".format(spec["description"][0]))
+    else:
+        emit("    description = ': '.join(part for part in ({}) if part)".format(
+            ", ".join("row[{}]".format(column) for column in spec["description"])))
+    emit("    if not description:")
+    emit("        raise InvalidInputError('missing description in row {}'.format(row_num))")
+
+    if spec["style"] == "amount":
+        emit("    amount = parse_money(row[{}], row_num)".format(spec["amount"]))
+        emit("    if not amount:")
+        emit("        raise InvalidInputError('zero amount in row {}'.format(row_num))")
+        emit("    if amount > 0:")
+        emit("        transaction_type = 'credit'")
+        emit("    else:")
+        emit("        transaction_type = 'debit'")
+        emit("        amount = -amount")
+        emit("    account = {}".format(repr(spec["account"])))
+        accounts = "account"
+    elif spec["style"] == "debit":
+        emit("    debit = parse_money(row[{}], row_num)".format(spec["debit"]))
+        emit("    credit = parse_money(row[{}], row_num)".format(spec["credit"]))
+        emit("    if debit and credit:")
+        emit("        raise InvalidInputError('both credit and debit in row {}'.format(row_num))")
+        emit("    if not debit and not credit:")
+        emit("        raise InvalidInputError('neither credit nor debit in row {}'.format(row_num))")
+        emit("    if debit:")
+        emit("        transaction_type = 'debit'")
+        emit("        amount = abs(debit)")
+        emit("    else:")
+        emit("        transaction_type = 'credit'")
+        emit("        amount = abs(credit)")
+        emit("    account = {}".format(repr(spec["account"])))
+        accounts = "account"
+    else:
+        emit("    deltas = []")
+        for column, name in spec["accounts"]:
+            # Most of these columns are empty, so check before making
+            # a function call.
+            emit("    if row[{}]:".format(column))
+            emit("        delta = parse_money(row[{}], row_num)".format(column))
+            emit("        if delta:")
+            emit("            deltas.append((delta, {}))".format(repr(name)))
+        emit("    if len(deltas) == 1:")
+        emit("        amount, account = deltas[0]")
+        emit("        if amount > 0:")
+        emit("            transaction_type = 'credit'")
+        emit("        else:")
+        emit("            transaction_type = 'debit'")
+        emit("            amount = -amount")
+        emit("    elif len(deltas) == 2:")
+        emit("        (delta1, account1), (delta2, account2) = deltas")
+        emit("        if delta1 != -delta2:")
+        emit("            raise InvalidInputError('unbalanced transfer in row {}, got deltas {} and {}'")
+        emit("                                    .format(row_num, delta1, delta2))")
+        emit("        transaction_type = 'transfer'")
+        emit("        amount = abs(delta1)")
+        emit("        if delta1 < 0:")
+        emit("            source, target = account1, account2")
+        emit("        else:")
+        emit("            source, target = account2, account1")
+        emit("    else:")
+        emit("        raise InvalidInputError('need exactly one or two deltas in row {}, got {}: {}'")
+        emit("                                .format(row_num, len(deltas), repr([d for d, a in deltas])))")
+        emit("    if transaction_type == 'transfer':")
+        emit("        accounts = [source, target]")
+        emit("    else:")
+        emit("        accounts = account")
+        accounts = "accounts"
+
+    emit("    transaction = {")
+    emit("        'id': transaction_id(id_scheme, {}, {}, {}),".format(
+        repr(importer_name), accounts, identity))
+    emit("        'description': description,")
+    emit("        'amount': amount,")
+    emit("        'type': transaction_type,")
+    emit("    }")
+    if spec["style"] == "accounts":
+        emit("    if transaction_type == 'transfer':")
+        emit("        transaction['source-account'] = source")
+        emit("        transaction['target-account'] = target")
+        emit("    else:")
+        emit("        transaction['account'] = account")
+    else:
+        emit("    transaction['account'] = account")
+    emit("    transaction['date'] = date")
+    if spec["tags"]:
+        emit("    transaction['tags'] = [tag for tag in ({},) if tag]".format(
+            ", ".join("row[{}]".format(column) for column in spec["tags"])))
+    for key, column, field_type in spec["fields"]:
+        if field_type == "string":
+            emit("    transaction[{}] = row[{}] or None".format(repr(key), column))
+        elif field_type == "money":
+            emit("    transaction[{}] = parse_money(row[{}], row_num)".format(
+                repr(key), column))
+        else:
+            emit("    transaction[{}] = bool(row[{}])".format(repr(key), column))
+    emit("    return transaction")
+
+    namespace = {
+        "InvalidInputError": InvalidInputError,
+        "parse_date": dateutil.parser.parse,
+        "strptime": datetime.datetime.strptime,
+        "transaction_id": acc.transaction_id,
+    }
+    code = compile("\n".join(lines) + "\n", "<spec_csv {}>".format(importer_name), "exec")
+    exec(code, namespace)
+    return namespace["parse_row"]
+
+## Parsing
+
+def row_digest(row):
+    # Short digest of a row, to count identical rows by in checkpoints
+    # without storing the rows themselves.
+    return acc.sha256_hex(json.dumps(row).encode())[:16]
+
+def read_rows(data, spec, parse_row, offset=0, rows=0, id_scheme="random",
+              occurrences=None):
+    # As in radon_csv, footer rows are never included in the
+    # checkpoint. Without an id column, identical rows are told apart
+    # by how many came before them, which only matters for
+    # content-derived IDs; occurrences maps the digest of each row
+    # read so far to that count, and is returned updated (or None if
+    # not needed).
+    lines = list(acc.iter_csv_rows(data, offset))
+    if spec["footer-rows"]:
+        lines = lines[:-spec["footer-rows"]]
+    if spec["id"] is None and id_scheme == "content":
+        occurrences = dict(occurrences or {})
+    else:
+        occurrences = None
+    transactions = []
+    for row, end in lines:
+        rows += 1
+        if rows > spec["header-rows"]:
+            occurrence = 0
+            if occurrences is not None:
+                digest = row_digest(row)
+                occurrence = occurrences.get(digest, 0)
+                occurrences[digest] = occurrence + 1
+            transactions.append(parse_row(row, rows, id_scheme, occurrence))
+        offset = end
+    return transactions, offset, rows, occurrences
+
+def load_spec(spec_name, spec_file, io):
+    if spec_file is not None:
+        try:
+            with io.open(spec_file) as f:
+                return json.load(f)
+        except OSError as e:
+            raise acc.FilesystemError(
+                "could not read file {}: {}".format(repr(spec_file), str(e)))
+        except ValueError as e:
+            raise acc.UserDataError(
+                "malformed JSON in {}: {}".format(repr(spec_file), str(e)))
+    config = getattr(io, "config", None) or {}
+    specs = config.get("importers", {})
+    if spec_name not in specs:
+        raise acc.UserDataError(
+            "no importer spec named {} in config file".format(repr(spec_name)))
+    return specs[spec_name]
+
+## Command line
+
+USAGE = ("(--spec <name> | --spec-file <spec-file>) --from <csv-file> "
+         "--to <json-file> [--account <account>] [--incremental]")
+
+def usage():
+    return acc.StandardUsageError(USAGE)
+
+def run(args, io):
+    spec_name = None
+    spec_file = None
+    csv_path = None
+    json_path = None
+    account = None
+    incremental = False
+    while args:
+        if args[0] in ("--spec", "--spec-file", "--from", "--to", "--account"):
+            if len(args) == 1:
+                raise usage()
+            if args[0] == "--spec":
+                spec_name = args[1]
+            elif args[0] == "--spec-file":
+                spec_file = args[1]
+            elif args[0] == "--from":
+                csv_path = args[1]
+            elif args[0] == "--to":
+                json_path = args[1]
+            else:
+                account = args[1]
+            args = args[2:]
+        elif args[0] == "--incremental":
+            incremental = True
+            args = args[1:]
+        else:
+            raise usage()
+    if (spec_name is None) == (spec_file is None):
+        raise usage()
+    if csv_path is None or json_path is None:
+        raise usage()
+    spec = load_spec(spec_name, spec_file, io)
+    name = spec_name if spec_name is not None else spec_file
+    try:
+        spec = normalize_spec(spec, account)
+    except InvalidSpecError as e:
+        raise InvalidSpecError("in importer spec {}: {}".format(repr(name), str(e)))
+    # Content-derived IDs are qualified by the spec name, so that two
+    # banks whose native IDs happen to collide get different IDs. A
+    # spec file has to name itself, since its path depends on where
+    # acc is run from.
+    id_name = spec["name"] if spec["name"] is not None else spec_name
+    if id_name is None:
+        raise InvalidSpecError(
+            "in importer spec {}: missing key 'name'".format(repr(name)))
+    parse_row = compile_spec(spec, "spec_csv:" + id_name)
+    metadata = {
+        "accounts": spec_accounts(spec),
+    }
+    def read(data, offset, rows, id_scheme, occurrences):
+        return read_rows(
+            data, spec, parse_row, offset, rows, id_scheme, occurrences)
+    acc.run_csv_import(csv_path, json_path, metadata, read, incremental, io)
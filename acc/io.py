@@ -2,6 +2,28 @@ import os
 import shutil
 import subprocess
 import sys
+import tempfile
+
+def fsync_directory(path):
+    # Make renames within the directory durable. Not every platform
+    # can open directories, in which case there is nothing to do.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def default_file_mode():
+    # The mode that open() gives new files, which depends on the
+    # umask. It can only be read by setting it, so set it back.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
 
 class StandardIO:
     def __init__(self):
@@ -11,6 +33,8 @@ class StandardIO:
         self.isdir = os.path.isdir
         self.dirname = os.path.dirname
         self.abspath = os.path.abspath
+        self.realpath = os.path.realpath
+        self.basename = os.path.basename
         self.islink = os.path.islink
         self.exists = os.path.exists
         self.which = shutil.which
@@ -21,5 +45,21 @@ class StandardIO:
         self.open = open
         self.getcwd = os.getcwd
         self.isfile = os.path.isfile
+        self.stat = os.stat
+        self.replace = os.replace
+        self.mkstemp = tempfile.mkstemp
+        self.chmod = os.chmod
+        self.default_file_mode = default_file_mode
+        self.close_fd = os.close
+        self.remove = os.remove
+        self.fsync = os.fsync
+        self.fsync_directory = fsync_directory
+        self.listdir = os.listdir
+        self.rmtree = shutil.rmtree
+        self.walk = os.walk
+        self.relpath = os.path.relpath
+        self.expanduser = os.path.expanduser
+        self.environ = os.environ
+        self.cpu_count = os.cpu_count
         self.DEVNULL = subprocess.DEVNULL
         self.PIPE = subprocess.PIPE